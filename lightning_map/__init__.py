@@ -1,26 +1,46 @@
+import os
+
 from dagster import IOManager, Definitions, ScheduleDefinition, define_asset_job, load_assets_from_package_module
 
 from .assets import etl, clustering
+from .resources import DuckDBResource
+from .sensors import build_granule_sensor, build_clustering_sensor, build_catch_up_schedule
 
-etl_asset_job = define_asset_job(name="etl_job", selection=["source", "transformations", "destination"])
-hourly_etl_schedule = ScheduleDefinition(
-    job=etl_asset_job,
-    cron_schedule="@hourly",
-    execution_timezone="America/New_York"
-)
+etl_asset_job = define_asset_job(name="etl_job", selection=["source", "transformations", "destination", "flash_grid"])
+# Micro-batches: new granules within a minute or so of landing, then the hour they fall in is reclustered
+new_granule_sensor = build_granule_sensor(etl_asset_job, minimum_interval_seconds=int(os.getenv("SENSOR_INTERVAL_SECONDS", 60)))
+# Materializes each hour partition once it has closed, catching anything the sensor missed
+hourly_etl_schedule = build_catch_up_schedule(etl_asset_job)
 
+# Manual backfills, ingestor materializes hours outside the instance so sensors can not see its runs
 ingestion_asset_job = define_asset_job(name="ingestion_job", selection="ingestor")
-clustering_job = define_asset_job(name="clustering_job", selection=["ingestor", "preprocessor", "kmeans_cluster", "Silhouette_evaluator"])
+# Clustering reads what the ETL sensor and catch-up schedule loaded, it does not ingest itself
+clustering_job = define_asset_job(name="clustering_job", selection=["preprocessor", "kmeans_cluster", "k_sweeper", "Silhouette_evaluator"])
+density_clustering_job = define_asset_job(name="density_clustering_job", selection=["preprocessor", "dbscan_cluster"])
+micro_clustering_job = define_asset_job(name="micro_clustering_job", selection=["preprocessor", "kmeans_cluster"])
+micro_clustering_sensor = build_clustering_sensor(etl_asset_job, micro_clustering_job)
+# After the catch-up ETL of the hour that just closed
 hourly_clustering_schedule = ScheduleDefinition(
     job=clustering_job,
-    cron_schedule="@hourly",
-    execution_timezone="America/New_York"
+    cron_schedule="15 * * * *",
+    execution_timezone="UTC"
 )
+# Archive, compact and clean up once a day
+maintenance_job = define_asset_job(name="maintenance_job", selection=["maintenance", "cluster_maintenance"])
+daily_maintenance_schedule = ScheduleDefinition(job=maintenance_job, cron_schedule="@daily")
 
 # Data assets definitions
 defs = Definitions(
     assets=load_assets_from_package_module(assets), 
-    jobs=[etl_asset_job, ingestion_asset_job, clustering_job],
+    jobs=[etl_asset_job, ingestion_asset_job, clustering_job, density_clustering_job, micro_clustering_job, maintenance_job],
     # resources: s3, io_manager
-    schedules=[hourly_etl_schedule, hourly_clustering_schedule],
+    resources={
+        "duckdb": DuckDBResource(
+            data_folder=os.getenv("DATA_FOLDER", ""),
+            threads=int(os.getenv("DUCKDB_THREADS", 0)),
+            memory_limit=os.getenv("DUCKDB_MEMORY_LIMIT", ""),
+        ),
+    },
+    schedules=[hourly_etl_schedule, hourly_clustering_schedule, daily_maintenance_schedule],
+    sensors=[new_granule_sensor, micro_clustering_sensor],
 )
\ No newline at end of file
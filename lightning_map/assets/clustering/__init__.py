@@ -1,88 +1,240 @@
 import os
 
 import pandas as pd
-import duckdb as db
 
-from dagster import asset, RetryPolicy
-from .clustering import preprocess, kmeans_model, sil_evaluation, elb_evaluation
+from typing import List
+from dagster import asset, Config, RetryPolicy, MetadataValue
+from .clustering import preprocess, kmeans_model, minibatch_model, dbscan_model, cluster_centers, centroid_drift, save_centroids, load_centroids, save_window_clusters, save_window_scores, prune_clusters, k_sweep, sil_evaluation, elb_evaluation
 from .ingestor import ingestion
+from .cache import fingerprint, memoize
+from .. import etl as etl_assets
+from ..metrics import stage_metrics
+from ...resources import DuckDBResource
 from datetime import datetime, timedelta
 
-# Date range
-dt = datetime.utcnow() - timedelta(hours=1)
-start_date = str(dt)
-end_date = str(dt)
-hours = dt.strftime('%H')
-
 # 24 hours
 # hours = ["00", "01", "02", "03", "04", "05", "06", "07", "08", "09", "10", "11", 
 #             "12", "13", "14", "15", "16", "17", "18", "19", "20", "21", "22", "23"]
 
 
-def db_connect(process: str):
+def db_connect(duckdb: DuckDBResource, process: str):
     if process == "preprocess":
-        # conn string for preprocess data
-        conn = db.connect("data/Load/glmFlash.db")
-        lat_df = conn.execute("SELECT * FROM tbl_flash_lat;").df() # latitude co-ordinates
-        lon_df = conn.execute("SELECT * FROM tbl_flash_lon;").df() # longitude co-ordinates
-        return lat_df, lon_df
+        # read-only flash data, the ETL may be writing it
+        conn = duckdb.get_read_connection("flash")
+        return conn
     elif process == "model":
-        # conn string for model data
-        conn = db.connect("data/flashClusters.db")
+        # model data
+        conn = duckdb.get_connection("clusters")
         return conn
+    raise ValueError(f"Process {process} not found!")
+
+class IngestConfig(Config):
+    # Dates and hours to ingest, left empty the run's clustering window is ingested
+    start_date: str = ""
+    end_date: str = ""
+    hours: List[str] = []
+
+def run_created_at(context) -> datetime:
+    # Creation time of the run, the same for all of its steps and their retries
+    record = context.instance.get_run_record_by_id(context.run.run_id)
+    if record is None or record.create_timestamp is None:
+        return datetime.utcnow()
+    return record.create_timestamp.replace(tzinfo=None)
+
+def cluster_window(context) -> tuple:
+    """
+    Window of a run, resolved when it runs rather than when the code location loads:
+    its cluster/window_start tag (sensor micro-batches), else the hour before the run was created
+    """
+    tagged = context.run.tags.get("cluster/window_start")
+    if tagged:
+        start = datetime.fromisoformat(tagged)
+    else:
+        start = (run_created_at(context) - timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+    return start, start + timedelta(hours=int(os.getenv("CLUSTER_WINDOW_HOURS", 1)))
+
+def cache_config():
+    # On disk memo of model fits keyed by input content, disabled with CLUSTER_CACHE=0
+    if os.getenv("CLUSTER_CACHE", "1") != "1":
+        return None, 0
+    cache_folder = os.getenv("CACHE_FOLDER", os.path.join(etl_assets.data_folder(), "cache", "clustering"))
+    return cache_folder, int(os.getenv("CACHE_MAX_BYTES", 512 * 2**20))
+
+def skip_fit(context, stage: dict, data: pd.DataFrame, needed: int, model: str) -> pd.DataFrame:
+    """
+    Empty clusters with the model's output columns, for a window with fewer flashes than the
+    model needs: a quiet hour or an early micro-batch. Recorded in the metadata instead of failing.
+    """
+    context.log.warning(f"{len(data)} flashes in the window, {model} needs {needed}, skipping the fit")
+    stage.update({"rows_in": len(data), "rows_out": 0, "skipped": f"{len(data)} flashes, {model} needs {needed}"})
+    results = data.loc[:, ["lon", "lat"]].iloc[:0].copy()
+    results["Cluster"] = pd.Series([], index=results.index, dtype="int32").astype("category")
+    return results
 
 
 @asset(group_name="Ingest", description="Ingest data.", compute_kind="etl")
-def ingestor(context):
+def ingestor(context, config: IngestConfig, duckdb: DuckDBResource):
+    window_start, window_end = cluster_window(context)
+    start_date = config.start_date or str(window_start)
+    end_date = config.end_date or str(window_end - timedelta(hours=1))
+    hours = config.hours or sorted({h.strftime('%H') for h in pd.date_range(window_start, window_end, freq="h", inclusive="left")})
     context.log.info(f"Starting ingestion from {start_date} to {end_date}..")
-    return ingestion(start_date, end_date, hours, context)
+    return ingestion(start_date, end_date, hours, context, resources={"duckdb": duckdb})
 
-@asset(group_name="Cluster", description="Preprocess data.", compute_kind="prep", retry_policy=RetryPolicy(max_retries=3, delay=10))
-def preprocessor(context, ingestor):
+@asset(group_name="Cluster", description="Preprocess data.", compute_kind="prep", deps=[ingestor], retry_policy=RetryPolicy(max_retries=3, delay=10))
+def preprocessor(context, duckdb: DuckDBResource):
     # config data load
-    lat_df, lon_df = db_connect(process="preprocess")
-    context.log.info("Starting file extracts for lon ...")
-    context.log.info("Starting file extracts for lat ...")
-    results = []
-    preprocessing = preprocess(lat_df, lon_df, context)
-    results = pd.DataFrame(preprocessing)
+    conn = db_connect(duckdb, process="preprocess")
+    window_start, window_end = cluster_window(context)
+    context.log.info(f"Starting flash extracts for {window_start} to {window_end} ...")
+    with stage_metrics(context, "preprocessor") as stage:
+        results = preprocess(conn, window_start, window_end, context)
+        stage["rows_out"] = len(results)
+        stage["bytes_out"] = int(results.memory_usage(deep=True).sum())
+    conn.close()
+    context.log.info(f"Preprocessed {len(results)} flashes.")
     return results
 
 @asset(group_name="Cluster", description="Group data into 'k' clusters.", compute_kind="model")
-def kmeans_cluster(context, preprocessor: pd.DataFrame):
+def kmeans_cluster(context, preprocessor: pd.DataFrame, duckdb: DuckDBResource):
     k = int(os.getenv("NUM_OF_CLUSTERS", 12))
-    context.log.info(f"Starting cluster model, k={k}...")
-    results = []
-    clusters = kmeans_model(preprocessor, k, context)
-    results = pd.DataFrame(clusters)
-    context.log.info(f"Generated cluster model ...")
-    # save clusters to db
-    conn = db_connect(process="model")
-    try:
-        # create the table "cluster_analysis" from the DataFrame "results"
-        conn.sql("CREATE TABLE cluster_analysis AS SELECT * FROM results")
-    except Exception as db_insert:
-        # insert into the table "cluster_analysis" from the DataFrame "results"
-        conn.sql("INSERT INTO cluster_analysis SELECT * FROM results")
+    # exact: full k-means refit, streaming: mini-batch warm started from the last centroids
+    mode = os.getenv("CLUSTER_MODE", "exact")
+    window_start, window_end = cluster_window(context)
+    context.log.info(f"Starting {mode} cluster model, k={k}...")
+    with stage_metrics(context, "kmeans_cluster") as stage:
+        if len(preprocessor) < k:
+            return skip_fit(context, stage, preprocessor, k, "kmeans_cluster")
+        conn = db_connect(duckdb, process="model")
+        stage["rows_in"] = len(preprocessor)
+        if mode == "streaming":
+            centroids = load_centroids(conn, k)
+            context.log.info(f"Warm start from saved centroids: {centroids is not None}")
+            results, centroids = minibatch_model(preprocessor, k, centroids, context=context)
+            if os.getenv("CLUSTER_DRIFT_CHECK", "0") == "1":
+                # Compare against a full refit on request
+                drift = centroid_drift(preprocessor, centroids, k, context)
+                context.log.info(f"Streaming drift vs full refit: {drift}")
+                stage.update(drift)
+        else:
+            def fit():
+                fitted = kmeans_model(preprocessor, k, context)
+                return {"labels": fitted["Cluster"].astype("int32").to_numpy(), "centroids": cluster_centers(fitted)}
+
+            cache_folder, max_bytes = cache_config()
+            if cache_folder:
+                # Unchanged windows reuse the labels and centroids of their last fit
+                key = fingerprint(preprocessor, model="kmeans_model", k=k)
+                fitted, stage["cache_hit"] = memoize(cache_folder, key, fit, max_bytes, context)
+            else:
+                fitted = fit()
+            results = preprocessor.loc[:, ["lon", "lat"]]
+            results["Cluster"] = pd.Series(fitted["labels"], index=results.index).astype("category")
+            centroids = fitted["centroids"]
+        context.log.info(f"Generated cluster model ...")
+        save_centroids(conn, centroids, mode, window_start)
+        # save clusters to db, replacing earlier runs of the window
+        method = "minibatch" if mode == "streaming" else "kmeans"
+        run = save_window_clusters(conn, results, window_start, window_end, method, context.run.run_id)
+        stage["rows_out"] = len(results)
+        stage["inertia"] = run["inertia"]
+        conn.close()
+    return results
+
+@asset(group_name="Cluster", description="Group data into density clusters, no 'k' needed.", compute_kind="model")
+def dbscan_cluster(context, preprocessor: pd.DataFrame, duckdb: DuckDBResource):
+    eps_km = float(os.getenv("DBSCAN_EPS_KM", 10))
+    min_samples = int(os.getenv("DBSCAN_MIN_SAMPLES", 5))
+    window_start, window_end = cluster_window(context)
+    context.log.info(f"Starting density cluster model, eps={eps_km}km, min_samples={min_samples}...")
+    with stage_metrics(context, "dbscan_cluster") as stage:
+        if preprocessor.empty:
+            return skip_fit(context, stage, preprocessor, 1, "dbscan_cluster")
+        results = dbscan_model(preprocessor, eps_km, min_samples, context=context)
+        labels = results["Cluster"].astype(int)
+        stage.update({
+            "rows_in": len(preprocessor),
+            "rows_out": len(results),
+            "clusters": int(labels[labels >= 0].nunique()),
+            "noise_fraction": round(float((labels < 0).mean()), 4) if len(labels) else 0.0,
+        })
+        context.log.info(f"Generated density cluster model ...")
+        # save clusters to db, same schema as kmeans_cluster
+        conn = db_connect(duckdb, process="model")
+        save_window_clusters(conn, results, window_start, window_end, "dbscan", context.run.run_id)
+        conn.close()
+    return results
+
+@asset(group_name="Cluster", description="Fit and score each 'k' once for the evaluators.", compute_kind="eval", retry_policy=RetryPolicy(max_retries=3, delay=10))
+def k_sweeper(context, kmeans_cluster: pd.DataFrame, duckdb: DuckDBResource):
+    max_workers = int(os.getenv("SWEEP_WORKERS", min(8, os.cpu_count() or 1)))
+    sample_size = int(os.getenv("SILHOUETTE_SAMPLE_SIZE", 10000))
+    context.log.info(f"Starting k sweep with {max_workers} workers ...")
+    with stage_metrics(context, "k_sweeper") as stage:
+        if kmeans_cluster.empty:
+            context.log.warning("No clusters in the window, skipping the k sweep")
+            stage.update({"rows_in": 0, "rows_out": 0, "skipped": "0 flashes, k_sweeper needs 1"})
+            return pd.DataFrame([], columns=["k", "inertia", "silhouette", "fit_seconds"])
+        # k can not exceed the number of flashes
+        k_values = range(1, min(24, len(kmeans_cluster) + 1))
+        cache_folder, max_bytes = cache_config()
+        if cache_folder:
+            # The sweep only depends on the points, not on their labels
+            key = fingerprint(kmeans_cluster, model="k_sweep", k_values=k_values, sample_size=sample_size)
+            results, stage["cache_hit"] = memoize(cache_folder, key, lambda: k_sweep(kmeans_cluster, k_values, max_workers, sample_size, context), max_bytes, context)
+        else:
+            results = k_sweep(kmeans_cluster, k_values, max_workers, sample_size, context)
+        # save the window's scores to db
+        conn = db_connect(duckdb, process="model")
+        save_window_scores(conn, results, cluster_window(context)[0], context.run.run_id)
+        conn.close()
+        stage.update({
+            "rows_in": len(kmeans_cluster),
+            "rows_out": len(results),
+            "fit_seconds": round(float(results["fit_seconds"].sum()), 3),
+            "sweep": MetadataValue.md(results.to_markdown(index=False)),
+            "latencies": [] if stage.get("cache_hit") else list(results["fit_seconds"]),
+        })
     return results
 
 @asset(group_name="Cluster", description="Silhouette coefficient score 'k'.", compute_kind="eval", retry_policy=RetryPolicy(max_retries=3, delay=10))
-def Silhouette_evaluator(context, kmeans_cluster: pd.DataFrame):
+def Silhouette_evaluator(context, k_sweeper: pd.DataFrame):
     context.log.info(f"Starting silhouette evaluation ...")
-    sil_coefficients = sil_evaluation(kmeans_cluster, context)
-    results = sil_coefficients.set_index('k', drop=True)
-    k_max = results['silhouette_coefficient'].argmax()
+    with stage_metrics(context, "Silhouette_evaluator") as stage:
+        sil_coefficients = sil_evaluation(None, context, sweep=k_sweeper)
+        results = sil_coefficients.set_index('k', drop=True)
+        if results['silhouette_coefficient'].notna().sum() == 0:
+            # Fewer than 2 clusters scored, keep the current k
+            stage.update({"rows_in": len(k_sweeper), "rows_out": len(results), "skipped": "no silhouette scores"})
+            return results
+        k_max = results['silhouette_coefficient'].idxmax()
+        stage.update({"rows_in": len(k_sweeper), "rows_out": len(results), "best_k": int(k_max)})
     context.log.info(f"Silhoutte coefficients: {results}")
     os.environ["NUM_OF_CLUSTERS"] = str(k_max)
     # save evaluations db
     return results
 
 @asset(group_name="Cluster", description="Elbow method score 'k'.", compute_kind="eval")
-def elbow_evaluator(context, kmeans_cluster: pd.DataFrame):
-    context.log.info(f"Starting elbow evaluation: {kmeans_cluster}")
+def elbow_evaluator(context, k_sweeper: pd.DataFrame):
+    context.log.info(f"Starting elbow evaluation ...")
     results = []
-    elb_sse = elb_evaluation(kmeans_cluster, context)
-    results.append(elb_sse)
+    with stage_metrics(context, "elbow_evaluator") as stage:
+        elb_sse = elb_evaluation(None, context, sweep=k_sweeper)
+        results.append(elb_sse)
+        stage.update({"rows_in": len(k_sweeper), "rows_out": len(elb_sse)})
     context.log.info(f"Elbow SSE ...")
     # save evaluations db
-    return results
\ No newline at end of file
+    return results
+
+@asset(group_name="Maintenance", description="Drop cluster outputs of windows past retention.", compute_kind="db maintenance")
+def cluster_maintenance(context, duckdb: DuckDBResource):
+    retention_days = int(os.getenv("CLUSTER_RETENTION_DAYS", os.getenv("RETENTION_DAYS", 30)))
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    with stage_metrics(context, "cluster_maintenance") as stage:
+        conn = db_connect(duckdb, process="model")
+        removed = prune_clusters(conn, cutoff)
+        conn.close()
+        duckdb.checkpoint("clusters")
+        context.log.info(f"Removed {removed} cluster points of windows before {cutoff}")
+        stage["rows_out"] = int(removed)
+    return removed
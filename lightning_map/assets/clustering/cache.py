@@ -0,0 +1,82 @@
+import os
+import json
+import pickle
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+def fingerprint(data: pd.DataFrame, **params) -> str:
+    """
+    Content hash of a frame's lon/lat arrays, its row count and the model parameters
+    """
+    digest = hashlib.sha256()
+    digest.update(str(len(data)).encode())
+    for column in ["lon", "lat"]:
+        digest.update(np.ascontiguousarray(data[column].to_numpy(dtype="float64")).tobytes())
+    # Parameters in a stable order, ranges and other iterables as lists
+    digest.update(json.dumps(params, sort_keys=True, default=lambda v: list(v) if hasattr(v, "__iter__") else repr(v)).encode())
+    return digest.hexdigest()
+
+def cache_get(cache_folder: str, key: str):
+    """
+    Cached value for key, or None. A hit refreshes the entry's place in the LRU order.
+    """
+    path = os.path.join(cache_folder, f"{key}.pkl")
+    try:
+        with open(path, "rb") as f:
+            value = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (pickle.UnpicklingError, EOFError):
+        # Truncated entry, drop it and recompute
+        os.remove(path)
+        return None
+    os.utime(path)
+    return value
+
+def cache_put(cache_folder: str, key: str, value, max_bytes: int=512 * 2**20) -> None:
+    """
+    Store value for key, then evict the least recently used entries above max_bytes
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    path = os.path.join(cache_folder, f"{key}.pkl")
+    # Write to a temp name so readers never see a partial entry
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    evict(cache_folder, max_bytes)
+
+def evict(cache_folder: str, max_bytes: int) -> list:
+    """
+    Remove the least recently used entries until the cache fits in max_bytes
+    """
+    entries = []
+    for filename in os.listdir(cache_folder):
+        if filename.endswith(".pkl"):
+            stat = os.stat(os.path.join(cache_folder, filename))
+            entries.append((stat.st_mtime, stat.st_size, filename))
+    total = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, filename in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_folder, filename))
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted.append(filename)
+    return evicted
+
+def memoize(cache_folder: str, key: str, compute, max_bytes: int=512 * 2**20, context: str=None) -> tuple:
+    """
+    Value of compute() cached under key, and whether it came from the cache
+    """
+    value = cache_get(cache_folder, key)
+    if value is not None:
+        return value, True
+    value = compute()
+    cache_put(cache_folder, key, value, max_bytes)
+    return value, False
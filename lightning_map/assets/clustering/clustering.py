@@ -1,20 +1,28 @@
 import os
+import time
 
+import numpy as np
 import pandas as pd
 
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-def preprocess(lat: pd.DataFrame, lon: pd.DataFrame, context: str=None) -> pd.DataFrame:
-    """Preprocess the data"""
-    # drop file name
-    lat.drop(lat.columns[[2]],axis=1,inplace=True)  
-    lon.drop(lon.columns[[2]],axis=1,inplace=True) 
-    # remove duplicates
-    lat.drop_duplicates(subset=['ts_date'], inplace=True)
-    lon.drop_duplicates(subset=['ts_date'], inplace=True)
-    # join data
-    geo_df = lon.join(lat.set_index('ts_date'), on='ts_date')
+# Mean earth radius, converts km to haversine radians
+EARTH_RADIUS_KM = 6371.0088
+
+def preprocess(conn, start: datetime, end: datetime, context: str=None) -> pd.DataFrame:
+    """
+    Preprocess the data: select the flashes in [start, end), drop duplicate loads of the same
+    flash and return their coordinates, all in one duckdb query
+    """
+    geo = conn.execute("""
+        SELECT ts AS ts_date, lon, lat
+        FROM flash
+        WHERE ts >= $start AND ts < $end
+        QUALIFY row_number() OVER (PARTITION BY source_file, flash_id ORDER BY ts) = 1
+        ORDER BY ts;
+        """, {"start": start, "end": end}).fetchnumpy()
+    geo_df = pd.DataFrame(geo)
 
     return geo_df
 
@@ -22,6 +30,8 @@ def kmeans_model(data: pd.DataFrame, num_clusters: int, context: str=None):
     """
     Fit data to kmeans cluster algorithm.
     """
+    # scikit-learn is imported by the models, it dominates the code location's load time
+    from sklearn.cluster import KMeans
     X = data.loc[:, ["lon", "lat"]]
     
     kmeans_kwargs = {
@@ -36,39 +46,309 @@ def kmeans_model(data: pd.DataFrame, num_clusters: int, context: str=None):
     X["Cluster"] = X["Cluster"].astype("category")
     return X
 
-def sil_evaluation(data: pd.DataFrame, context: str=None):
+def minibatch_model(data: pd.DataFrame, num_clusters: int, centroids: np.ndarray=None, batch_size: int=4096, context: str=None):
     """
-    Evaluate the k-means silhouette coefficient.
+    Fit data to mini-batch k-means, warm started from the previous run's centroids when
+    they match num_clusters, so a run only pays for the new flashes.
     """
-    data = data.loc[:, ["lon", "lat"]]
-    
+    from sklearn.cluster import MiniBatchKMeans
+    X = data.loc[:, ["lon", "lat"]]
+    warm_start = centroids is not None and len(centroids) == num_clusters
+
     kmeans_kwargs = {
-        "init": "k-means++",
-        "n_init": 10,
-        "max_iter": 50,
+        "init": centroids if warm_start else "k-means++",
+        "n_init": 1 if warm_start else 3,
+        "batch_size": batch_size,
+        "max_iter": 100,
         "random_state": 60,
     }
 
-    # holds the silhouette coefficients for each k
-    silhouette_coefficients = {}
+    kmeans = MiniBatchKMeans(n_clusters=num_clusters, **kmeans_kwargs)
+    X["Cluster"] = kmeans.fit_predict(X)
+    X["Cluster"] = X["Cluster"].astype("category")
+    return X, kmeans.cluster_centers_
 
+def dbscan_model(data: pd.DataFrame, eps_km: float=10.0, min_samples: int=5, cell_fraction: float=0.1, context: str=None):
+    """
+    Fit data to DBSCAN density clustering on great-circle distance, with neighbour queries
+    served by a haversine ball tree. Flashes are first snapped to a grid of cell_fraction * eps
+    and each occupied cell is fit once, weighted by its flash count. Noise is labelled -1.
+    """
+    from sklearn.cluster import DBSCAN
+    X = data.loc[:, ["lon", "lat"]]
+    # Grid pre-pass: snapping moves a flash at most ~0.7 cell, well inside eps
+    cell = cell_fraction * eps_km / EARTH_RADIUS_KM
+    cells = np.rint(np.radians(X[["lat", "lon"]].to_numpy(dtype="float64")) / cell)
+    cells, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
 
-    # start at 2 clusters for silhouette coefficient
-    for k in range(2, 24):
-        kmeans = KMeans(n_clusters=k, **kmeans_kwargs)
-        kmeans.fit(data)
-        score = silhouette_score(data, kmeans.labels_)
-        silhouette_coefficients[k] = score
-    
-    sil_df = pd.DataFrame(list(silhouette_coefficients.items()), columns=['k', 'silhouette_coefficient'])
+    dbscan_kwargs = {
+        "eps": eps_km / EARTH_RADIUS_KM,
+        "min_samples": min_samples,
+        "metric": "haversine",
+        "algorithm": "ball_tree",
+    }
 
-    return sil_df
+    dbscan = DBSCAN(**dbscan_kwargs)
+    labels = dbscan.fit_predict(cells * cell, sample_weight=counts)
+    X["Cluster"] = labels[inverse.ravel()]
+    X["Cluster"] = X["Cluster"].astype("category")
+    return X
 
-def elb_evaluation(data: pd.DataFrame, context: str=None):
+def cluster_centers(clusters: pd.DataFrame) -> np.ndarray:
     """
-    Evaluate the k-means elbow method, sum of squared error.
+    Centroid of each labelled cluster, ordered by label
     """
-    
+    return clusters.groupby("Cluster", observed=True)[["lon", "lat"]].mean().to_numpy()
+
+def centroid_drift(data: pd.DataFrame, centroids: np.ndarray, num_clusters: int, context: str=None) -> dict:
+    """
+    Compare streaming centroids with a full k-means refit: centroids are paired by
+    minimum total distance, drift is reported in degrees along with the inertia ratio.
+    """
+    from scipy.optimize import linear_sum_assignment
+    X = data.loc[:, ["lon", "lat"]].to_numpy()
+    exact = cluster_centers(kmeans_model(data, num_clusters, context))
+    distances = np.linalg.norm(centroids[:, None, :] - exact[None, :, :], axis=2)
+    rows, cols = linear_sum_assignment(distances)
+
+    def inertia(centers):
+        # Sum of squared distances to the nearest centroid
+        return float(np.min(np.linalg.norm(X[:, None, :] - centers[None, :, :], axis=2) ** 2, axis=1).sum())
+
+    return {
+        "drift_mean_deg": float(distances[rows, cols].mean()),
+        "drift_max_deg": float(distances[rows, cols].max()),
+        "inertia_ratio": inertia(centroids) / max(inertia(exact), 1e-12),
+    }
+
+def save_centroids(conn, centroids: np.ndarray, mode: str, window_start: datetime=None) -> None:
+    """
+    Persist a run's centroids for the next run to warm start from
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cluster_centroids (
+            run_at TIMESTAMP,
+            mode VARCHAR,
+            k INTEGER,
+            cluster INTEGER,
+            lon DOUBLE,
+            lat DOUBLE
+        );
+        ALTER TABLE cluster_centroids ADD COLUMN IF NOT EXISTS window_start TIMESTAMP;
+        """)
+    centers = pd.DataFrame(centroids, columns=["lon", "lat"])
+    centers.insert(0, "cluster", range(len(centers)))
+    conn.execute("""
+        INSERT INTO cluster_centroids (run_at, mode, k, cluster, lon, lat, window_start)
+        SELECT now(), ?, ?, cluster, lon, lat, ? FROM centers;
+        """, [mode, len(centers), window_start])
+
+def load_centroids(conn, num_clusters: int):
+    """
+    Most recent centroids saved for num_clusters, or None
+    """
+    exists = conn.execute("SELECT count(*) FROM information_schema.tables WHERE table_name = 'cluster_centroids';").fetchone()[0]
+    if not exists:
+        return None
+    centers = conn.execute("""
+        SELECT lon, lat FROM cluster_centroids
+        WHERE k = ? AND run_at = (SELECT max(run_at) FROM cluster_centroids WHERE k = ?)
+        ORDER BY cluster;
+        """, [num_clusters, num_clusters]).fetchnumpy()
+    if len(centers["lon"]) == 0:
+        return None
+    return np.column_stack([centers["lon"], centers["lat"]])
+
+def create_cluster_tables(conn) -> None:
+    """
+    Create the window keyed cluster tables: points with their labels, and one row per run.
+    A cluster_analysis table from before windows is kept aside as cluster_analysis_legacy.
+    """
+    columns = [c for (c,) in conn.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'cluster_analysis';").fetchall()]
+    if columns and "window_start" not in columns:
+        conn.execute("ALTER TABLE cluster_analysis RENAME TO cluster_analysis_legacy;")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cluster_analysis (
+            window_start TIMESTAMP,
+            method VARCHAR,
+            run_id VARCHAR,
+            lon DOUBLE,
+            lat DOUBLE,
+            Cluster INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS cluster_analysis_window ON cluster_analysis (window_start, method);
+        CREATE TABLE IF NOT EXISTS cluster_runs (
+            window_start TIMESTAMP,
+            window_end TIMESTAMP,
+            method VARCHAR,
+            run_id VARCHAR,
+            run_at TIMESTAMP,
+            k INTEGER,
+            points BIGINT,
+            noise BIGINT,
+            inertia DOUBLE,
+            silhouette DOUBLE
+        );
+        CREATE TABLE IF NOT EXISTS cluster_scores (
+            window_start TIMESTAMP,
+            run_id VARCHAR,
+            k INTEGER,
+            inertia DOUBLE,
+            silhouette DOUBLE
+        );
+        """)
+
+def cluster_inertia(clusters: pd.DataFrame) -> float:
+    """
+    Sum of squared distances of labelled points to their cluster's mean, noise excluded
+    """
+    labelled = clusters[clusters["Cluster"].astype(int) >= 0]
+    if labelled.empty:
+        return None
+    X = labelled[["lon", "lat"]].to_numpy()
+    labels = labelled["Cluster"].astype(int).to_numpy()
+    _, inverse = np.unique(labels, return_inverse=True)
+    sums = np.zeros((inverse.max() + 1, 2))
+    np.add.at(sums, inverse, X)
+    means = sums / np.bincount(inverse)[:, None]
+    return float(((X - means[inverse]) ** 2).sum())
+
+def save_window_clusters(conn, clusters: pd.DataFrame, window_start: datetime, window_end: datetime, method: str, run_id: str=None, silhouette: float=None) -> dict:
+    """
+    Replace the points and run record of one window and method with this run's, so
+    reruns of a window never duplicate it. Points are bulk inserted from Arrow.
+    """
+    import pyarrow as pa
+    create_cluster_tables(conn)
+    labels = clusters["Cluster"].astype("int32").to_numpy()
+    points = pa.table({
+        "window_start": pa.array(np.full(len(clusters), np.datetime64(window_start, "us"))),
+        "method": pa.array([method] * len(clusters), pa.string()),
+        "run_id": pa.array([run_id] * len(clusters), pa.string()),
+        "lon": pa.array(clusters["lon"].to_numpy(dtype="float64")),
+        "lat": pa.array(clusters["lat"].to_numpy(dtype="float64")),
+        "Cluster": pa.array(labels),
+    })
+    run = {
+        "window_start": window_start,
+        "window_end": window_end,
+        "method": method,
+        "run_id": run_id,
+        "k": int(len(np.unique(labels[labels >= 0]))),
+        "points": len(clusters),
+        "noise": int((labels < 0).sum()),
+        "inertia": cluster_inertia(clusters),
+        "silhouette": silhouette,
+    }
+    conn.execute("BEGIN TRANSACTION;")
+    try:
+        conn.execute("DELETE FROM cluster_analysis WHERE window_start = ? AND method = ?;", [window_start, method])
+        conn.execute("DELETE FROM cluster_runs WHERE window_start = ? AND method = ?;", [window_start, method])
+        conn.register("window_points", points)
+        conn.execute("INSERT INTO cluster_analysis BY NAME SELECT * FROM window_points;")
+        conn.unregister("window_points")
+        conn.execute("""
+            INSERT INTO cluster_runs
+            VALUES ($window_start, $window_end, $method, $run_id, now(), $k, $points, $noise, $inertia, $silhouette);
+            """, run)
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    return run
+
+def save_window_scores(conn, scores: pd.DataFrame, window_start: datetime, run_id: str=None) -> None:
+    """
+    Replace the k sweep scores of a window
+    """
+    create_cluster_tables(conn)
+    sweep = scores.loc[:, ["k", "inertia", "silhouette"]]
+    conn.execute("BEGIN TRANSACTION;")
+    try:
+        conn.execute("DELETE FROM cluster_scores WHERE window_start = ?;", [window_start])
+        conn.execute("""
+            INSERT INTO cluster_scores
+            SELECT ?, ?, k, inertia, silhouette FROM sweep;
+            """, [window_start, run_id])
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+
+def window_clusters(conn, window_start: datetime, method: str) -> pd.DataFrame:
+    # Points and labels of one window, an index lookup
+    return conn.execute("""
+        SELECT lon, lat, Cluster FROM cluster_analysis
+        WHERE window_start = ? AND method = ?;
+        """, [window_start, method]).df()
+
+def latest_clusters(conn, method: str="kmeans") -> tuple:
+    """
+    Points and labels of the most recent clustered window for method, with its run record
+    """
+    create_cluster_tables(conn)
+    run = conn.execute("""
+        SELECT * FROM cluster_runs WHERE method = ?
+        ORDER BY window_start DESC, run_at DESC LIMIT 1;
+        """, [method]).df()
+    if run.empty:
+        return pd.DataFrame([], columns=["lon", "lat", "Cluster"]), run
+    return window_clusters(conn, run["window_start"].iloc[0].to_pydatetime(), method), run
+
+def clusters_for_hour(conn, hour: datetime, method: str="kmeans") -> tuple:
+    """
+    Points and labels of the latest window covering hour, with its run record
+    """
+    create_cluster_tables(conn)
+    run = conn.execute("""
+        SELECT * FROM cluster_runs
+        WHERE method = ? AND window_start <= ? AND window_end > ?
+        ORDER BY window_start DESC, run_at DESC LIMIT 1;
+        """, [method, hour, hour]).df()
+    if run.empty:
+        return pd.DataFrame([], columns=["lon", "lat", "Cluster"]), run
+    return window_clusters(conn, run["window_start"].iloc[0].to_pydatetime(), method), run
+
+def prune_clusters(conn, cutoff: datetime) -> int:
+    """
+    Drop cluster points, runs, scores and centroids of windows older than cutoff, returning the points removed
+    """
+    create_cluster_tables(conn)
+    (removed,) = conn.execute("DELETE FROM cluster_analysis WHERE window_start < ?;", [cutoff]).fetchone()
+    conn.execute("DELETE FROM cluster_runs WHERE window_start < ?;", [cutoff])
+    conn.execute("DELETE FROM cluster_scores WHERE window_start < ?;", [cutoff])
+    exists = conn.execute("SELECT count(*) FROM information_schema.tables WHERE table_name = 'cluster_centroids';").fetchone()[0]
+    if exists:
+        # Keep the latest centroids of each k, streaming runs warm start from them
+        conn.execute("""
+            DELETE FROM cluster_centroids
+            WHERE run_at < ? AND run_at < (SELECT max(run_at) FROM cluster_centroids latest WHERE latest.k = cluster_centroids.k);
+            """, [cutoff])
+    return removed
+
+def fit_k(X: np.ndarray, k: int, kmeans_kwargs: dict, sample_size: int=None) -> dict:
+    """
+    Fit one k and score it: inertia always, silhouette when 2 <= k < n
+    """
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
+    start = time.perf_counter()
+    kmeans = KMeans(n_clusters=k, **kmeans_kwargs)
+    kmeans.fit(X)
+    fit_seconds = time.perf_counter() - start
+    silhouette = np.nan
+    if 2 <= k < len(X):
+        # Sampled silhouette avoids the O(n^2) pairwise distances on busy hours
+        silhouette = silhouette_score(X, kmeans.labels_, sample_size=sample_size, random_state=kmeans_kwargs["random_state"])
+    return {"k": k, "inertia": kmeans.inertia_, "silhouette": silhouette, "fit_seconds": fit_seconds}
+
+def k_sweep(data: pd.DataFrame, k_values=range(1, 24), max_workers: int=None, sample_size: int=10000, context: str=None) -> pd.DataFrame:
+    """
+    Fit each k once, in parallel, and score inertia and silhouette from the same fit.
+    Silhouette is sampled to sample_size points when there are more flashes than that.
+    """
+    X = data.loc[:, ["lon", "lat"]].to_numpy()
+
     kmeans_kwargs = {
         "init": "k-means++",
         "n_init": 10,
@@ -76,13 +356,37 @@ def elb_evaluation(data: pd.DataFrame, context: str=None):
         "random_state": 60,
     }
 
+    # k can not exceed the number of flashes
+    k_values = [k for k in k_values if k <= len(X)]
+    sample_size = sample_size if sample_size and len(X) > sample_size else None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fits = list(executor.map(lambda k: fit_k(X, k, kmeans_kwargs, sample_size), k_values))
+
+    sweep_df = pd.DataFrame(fits, columns=["k", "inertia", "silhouette", "fit_seconds"])
+
+    return sweep_df
+
+def sil_evaluation(data: pd.DataFrame, context: str=None, sweep: pd.DataFrame=None):
+    """
+    Evaluate the k-means silhouette coefficient.
+    """
+    # start at 2 clusters for silhouette coefficient
+    if sweep is None:
+        sweep = k_sweep(data, range(2, 24), context=context)
+    sweep = sweep[sweep["k"] >= 2]
+
+    sil_df = sweep.loc[:, ["k", "silhouette"]].rename(columns={"silhouette": "silhouette_coefficient"}).reset_index(drop=True)
+
+    return sil_df
+
+def elb_evaluation(data: pd.DataFrame, context: str=None, sweep: pd.DataFrame=None):
+    """
+    Evaluate the k-means elbow method, sum of squared error.
+    """
+    if sweep is None:
+        sweep = k_sweep(data, range(1, 24), context=context)
+
     # A list holds the sum of squared distance for each k
-    elb_sse = []
+    elb_sse = list(sweep["inertia"])
 
-    # Return SSE for each k
-    for k in range(1, 24):
-        kmeans = KMeans(n_clusters=k, **kmeans_kwargs)
-        kmeans.fit(data)
-        elb_sse.append(kmeans.inertia_)
-    
-    return elb_sse
\ No newline at end of file
+    return elb_sse
@@ -1,38 +1,54 @@
-
-import os 
+import os
+import time
 
 import pandas as pd
 from dagster import materialize
-from ..etl import source, transformations, destination
-
-def ingestion_config():
-    # Optional ETL parameters:
-    year = os.getenv("GOES_YEAR")
-    day_of_year = os.getenv("GOES_DOY")
-    hour = os.getenv("GOES_HOUR")
-    # Required parameters:
-    bucket_name = os.getenv("S3_BUCKET") # Satellite i.e. GOES-18  
-    product_line = os.getenv("PRODUCT")  # Product line id i.e. ABI...
-    prefix = f"{product_line}/{year}/{day_of_year}/{hour}/"
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ...resources import DuckDBResource
+from ..etl import source, transformations, destination, flash_grid, etl_config, hourly_partitions
 
-    return prefix, bucket_name
+def work_units(start_date: str, end_date: str, hours) -> list:
+    """
+    Partition keys of every date and hour in the range, one independent unit of work each
+    """
+    # A single hour may be given as a string
+    hours = [hours] if isinstance(hours, str) else hours
+    units = []
+    for single_date in pd.date_range(pd.Timestamp(start_date).normalize(), pd.Timestamp(end_date).normalize(), freq="D"):
+        for single_hour in hours:
+            single_hour = str(single_hour).rjust(2,'0')
+            units.append(f"{single_date.strftime('%Y-%m-%d')}-{single_hour}:00")
+    return units
 
-def ingestion(start_date: str, end_date: str, hours: [str], context: str=None):
-    """Collects the data"""
+def ingest_hour(partition_key: str, context: str=None, resources: dict=None) -> dict:
+    """
+    Materialize the ETL assets for one hour partition, in its own working folders
+    """
+    hour = hourly_partitions.time_window_for_partition_key(partition_key).start
+    prefix, bucket_name, extract_folder = etl_config(process="extract", hour=hour)
+    print(f"Partition: {partition_key}; Prefix: {prefix}; Bucket: {bucket_name}")
+    start = time.perf_counter()
+    record = {"partition_key": partition_key, "prefix": prefix, "success": False, "seconds": 0.0, "error": None}
+    try:
+        # Extract files
+        result = materialize([source, transformations, destination, flash_grid], partition_key=partition_key, resources=resources, raise_on_error=False)
+        record["success"] = result.success
+    except Exception as e:
+        record["error"] = str(e)
+        print(f"Error extracting files from {prefix}")
+    record["seconds"] = time.perf_counter() - start
+    return record
 
-    for single_date in pd.date_range(start_date, end_date, freq="D"):
-        for single_hour in hours:
-            single_hour = single_hour.rjust(2,'0')
-            print(f"Start date: {start_date}; End date: {end_date}; Hour: {single_hour}")
-            # Export env vars
-            os.environ["GOES_YEAR"] = single_date.strftime("%Y")
-            os.environ["GOES_DOY"] = single_date.strftime("%j")
-            os.environ["GOES_HOUR"] = str(single_hour)
-            # config file string
-            prefix, bucket_name = ingestion_config()
-            print(f"Prefix: {prefix}; Bucket: {bucket_name}")
-            try:
-                # Extract files
-                materialize([source, transformations, destination])
-            except Exception as e:
-                print(f"Error extracting files from {prefix}")
+def ingestion(start_date: str, end_date: str, hours: [str], context: str=None, max_workers: int=None, resources: dict=None):
+    """Collects the data, hours run concurrently on a bounded pool"""
+    max_workers = max_workers or int(os.getenv("BACKFILL_WORKERS", 4))
+    resources = resources or {"duckdb": DuckDBResource()}
+    units = work_units(start_date, end_date, hours)
+    print(f"Start date: {start_date}; End date: {end_date}; Hours: {len(units)}; Workers: {max_workers}")
+    records = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        jobs = [executor.submit(ingest_hour, partition_key, context, resources) for partition_key in units]
+        for job in as_completed(jobs):
+            records.append(job.result())
+    ingested = pd.DataFrame(records, columns=["partition_key", "prefix", "success", "seconds", "error"])
+    return ingested.sort_values("partition_key", ignore_index=True)
@@ -1,124 +1,261 @@
 import os
+import time
 import shutil
 import pandas as pd
 
 from datetime import datetime, date, timedelta
-from dagster import asset, RetryPolicy, MetadataValue
-from .etl import extract, transform, load
-from concurrent import futures
-from concurrent.futures import ProcessPoolExecutor
+from typing import List
+from dagster import asset, Config, RetryPolicy, MetadataValue, HourlyPartitionsDefinition
+from .etl import extract, transform, transform_files, load, stream_objects, load_frames, create_flash_tables
+from .downloader import s3_client, download_objects, transfer_stats
+from ..metrics import stage_metrics
+from ...resources import DuckDBResource
+from .grid import update_grid, hour_granules, prune_grid
+from .retention import archive_flashes, compact_database, collect_garbage
+from .manifest import list_objects, manifest_connect, sync_manifest, pending, processed, mark
 
-from botocore import UNSIGNED, exceptions
-from botocore.client import Config
-from boto3 import client
 from pathlib import Path
-from tqdm import tqdm
 
-def etl_config(process: str):
-    # Optional ETL parameters:
-    dt = datetime.utcnow() - timedelta(hours=1)
-    year = os.getenv("GOES_YEAR", dt.strftime('%Y'))
-    day_of_year = os.getenv("GOES_DOY", dt.strftime('%j'))
-    hour = os.getenv("GOES_HOUR", dt.strftime('%H'))
+def data_folder():
+    # Project data folder
+    basepath = Path(__file__).resolve().parent.parent.parent.parent
+    return os.path.join(basepath, "data")
+
+def manifest_config():
+    # Manifest database of listed s3 keys and their processing state
+    dest_folder = data_folder()
+    if not os.path.exists(dest_folder):
+        os.makedirs(dest_folder)
+    return os.path.join(dest_folder, "manifest.db")
+
+def archive_config():
+    # Hive partitioned parquet archive of flashes past retention
+    return os.path.join(data_folder(), "Archive", "flash")
+
+# One partition per GOES hour, UTC, including the hour in progress for sensor micro-batches
+hourly_partitions = HourlyPartitionsDefinition(start_date=os.getenv("GOES_START_DATE", "2023-01-01-00:00"), end_offset=1)
+
+class SourceConfig(Config):
+    # Only extract these keys of the partition, e.g. the new granules a sensor found; all pending keys if empty
+    keys: List[str] = []
+
+def goes_prefix(hour: datetime) -> str:
+    # s3 prefix of one GOES hour
+    return f"{os.getenv('PRODUCT')}/{hour.strftime('%Y/%j/%H')}/"
+
+def partition_hour(context):
+    # Start of the partition hour being materialized, if any
+    if context.has_partition_key:
+        return context.partition_time_window.start
+    return None
+
+def etl_config(process: str, hour: datetime=None, run_id: str=None):
+    # ETL parameters: the partition hour, else optional env parameters, else the previous hour
+    dt = hour or datetime.utcnow() - timedelta(hours=1)
+    year = dt.strftime('%Y') if hour else os.getenv("GOES_YEAR", dt.strftime('%Y'))
+    day_of_year = dt.strftime('%j') if hour else os.getenv("GOES_DOY", dt.strftime('%j'))
+    hour = dt.strftime('%H') if hour else os.getenv("GOES_HOUR", dt.strftime('%H'))
     # Required parameters:
     bucket_name = os.getenv("S3_BUCKET") # Satellite i.e. GOES-18  
     product_line = os.getenv("PRODUCT")  # Product line id i.e. ABI...
     prefix = f"{product_line}/{year}/{day_of_year}/{hour}/"
-    basepath = Path(__file__).resolve().parent.parent.parent.parent
+    basepath = Path(data_folder()).parent
+    # Each hour works in its own folders so hours can run concurrently
+    unit = os.path.join(year, day_of_year, hour)
+    # and each run of an hour in its own transform and staging folders, runs of one hour can overlap
+    run_unit = os.path.join(unit, run_id) if run_id else unit
     if process == "extract":
         src_folder = prefix
-        dest_folder = os.path.join(basepath, "data/Extract")
-        # Create folder if not existing
-        if not os.path.exists(dest_folder):
-            os.makedirs(dest_folder)
+        dest_folder = os.path.join(basepath, "data/Extract", unit)
     elif process == "transform":
-        src_folder = os.path.join(basepath, "data/Extract")
-        dest_folder = os.path.join(basepath, "data/transform")
-        # Create folder if not existing
-        if not os.path.exists(dest_folder):
-            os.makedirs(dest_folder)
+        src_folder = os.path.join(basepath, "data/Extract", unit)
+        dest_folder = os.path.join(basepath, "data/transform", run_unit)
     elif process == "load": 
-        src_folder = os.path.join(basepath, "data/transform")
-        dest_folder = os.path.join(basepath, "data/Load")
-        # Create folder if not existing
-        if not os.path.exists(dest_folder):
-            os.makedirs(dest_folder)
+        src_folder = os.path.join(basepath, "data/transform", run_unit)
+        dest_folder = os.path.join(basepath, "data/Load/staging", run_unit)
     else: 
-        context.log.info(f"Process {process} not found!")
+        raise ValueError(f"Process {process} not found!")
+    # Create folders if not existing
+    os.makedirs(dest_folder, exist_ok=True)
+    if process != "extract":
+        os.makedirs(src_folder, exist_ok=True)
 
     return src_folder, bucket_name, dest_folder
 
-@asset(group_name="ETL", description="Extract GOES netCDF files from s3 bucket.", compute_kind="s3 extract", retry_policy=RetryPolicy(max_retries=3, delay=10))
-def source(context):
+@asset(group_name="ETL", description="Extract GOES netCDF files from s3 bucket.", compute_kind="s3 extract", partitions_def=hourly_partitions, retry_policy=RetryPolicy(max_retries=3, delay=10))
+def source(context, config: SourceConfig, duckdb: DuckDBResource):
     # config file string
-    prefix, bucket_name, extract_folder = etl_config(process="extract")
-    # Navigate to folder
-    os.chdir(extract_folder)
-    results = []
-    context.log.info(f"Starting file extracts for: {prefix}")
-    # Configure s3 no sign in credential
-    s3 = client('s3', config=Config(signature_version=UNSIGNED))
-    # List existing files in buckets
-    for files in tqdm(s3.list_objects(Bucket=bucket_name, Prefix=prefix)['Contents'], total=180, ascii=" >=", desc=f"Extract {prefix}"):
-        # Download file from list
-        filepath = files['Key']
-        path, filename = os.path.split(filepath)
-        print(f"Dowloading {filename} to {os.path.join(extract_folder, filename)}")
-        s3_extract = extract(bucket_name, prefix, filename, filepath, context)
-        results.append(s3_extract)
-    # context.add_output_metadata({s3_extract -> results})
+    prefix, bucket_name, extract_folder = etl_config(process="extract", hour=partition_hour(context))
+    max_workers = int(os.getenv("EXTRACT_WORKERS", 16))
+    # extract: download granules to data/Extract, stream: decode in memory and load directly
+    mode = os.getenv("ETL_MODE", "extract")
+    context.log.info(f"Starting file {mode} for: {prefix} with {max_workers} workers")
+    with stage_metrics(context, "source") as stage:
+        # Shared unsigned s3 client, pooled across download workers
+        s3 = s3_client(max_workers)
+        # List existing files in buckets, record them in the manifest
+        conn = manifest_connect(manifest_config())
+        listed = sync_manifest(conn, prefix, list_objects(s3, bucket_name, prefix))
+        # Only fetch keys not yet extracted
+        objects = pending(conn, prefix, "extracted")
+        if config.keys:
+            keys = set(config.keys)
+            objects = [obj for obj in objects if obj['Key'] in keys]
+        context.log.info(f"{listed} keys listed for {prefix}, {len(objects)} new")
+        start = time.perf_counter()
+        if mode == "stream":
+            flashes, results = stream_objects(s3, bucket_name, objects, max_workers, context)
+            conn_db = duckdb.get_connection("flash")
+            loaded = load_frames(None, flashes, context, conn=conn_db)
+            conn_db.close()
+            mark(conn, list(results.loc[results["status"] == "downloaded", "filename"]), "loaded")
+            stage["rows_out"] = int(loaded["rows"].sum())
+        else:
+            results = download_objects(s3, bucket_name, objects, extract_folder, max_workers, context)
+            extracted = results[results["status"].isin(["downloaded", "skipped"])]
+            mark(conn, list(extracted["filename"]), "extracted")
+        conn.close()
+        stats = transfer_stats(results, time.perf_counter() - start)
+        context.log.info(f"Extract summary for {prefix}: {stats}")
+        stage.update(stats)
+        stage["bytes_out"] = stats["bytes"]
+        stage["latencies"] = list(results.loc[results["status"] == "downloaded", "seconds"])
+        failed = results[results["status"] == "error"]
+        if not failed.empty:
+            # Raise so the retry policy picks up the remaining files, completed files are skipped
+            raise RuntimeError(f"{len(failed)} of {len(results)} downloads failed for {prefix}: {failed['error'].iloc[0]}")
     return results
     
-@asset(group_name="ETL", description="Convert GOES netCDF files into csv files.", compute_kind="transform data", retry_policy=RetryPolicy(max_retries=3, delay=10))
+@asset(group_name="ETL", description="Convert GOES netCDF files into csv or parquet files.", compute_kind="transform data", partitions_def=hourly_partitions, retry_policy=RetryPolicy(max_retries=3, delay=10))
 def transformations(context, source):
     # config file string
-    extract_folder, bucket_name, transform_folder = etl_config(process="transform")
-    glm_files = [f for f in os.listdir(extract_folder) if f.endswith(".nc") ]
-    # Exit if source folder not existing
-    if not os.path.exists(extract_folder):
-        pass
-    # Empty destination folder or recreate
-    if not os.path.exists(transform_folder):
-        os.makedirs(transform_folder)
-    else:
-        filelist = [ f for f in os.listdir(transform_folder) if f.endswith(".csv") ]
-        for f in filelist:
-            os.remove(os.path.join(transform_folder, f))
-    results = []
-    context.log.info(f"Starting file conversions for: {extract_folder}")
-    # Convert glm files into one time series dataframe
-    for filename in tqdm(glm_files, desc=f"transform {extract_folder}"):
-        print(f"Converting {filename} to csv")
-        csv_transform = transform(extract_folder, transform_folder, filename, context)
-        os.rename(filename, f"{filename}.ext")
-        results.append(csv_transform)
-    # csv_transform -> results
+    extract_folder, bucket_name, transform_folder = etl_config(process="transform", hour=partition_hour(context), run_id=context.run.run_id)
+    # Skip granules already transformed on a previous run
+    conn = manifest_connect(manifest_config())
+    done = processed(conn, "transformed")
+    glm_files = [f for f in os.listdir(extract_folder) if f.endswith(".nc") and f not in done]
+    # The run's own folder: outputs of a retried attempt are kept for destination, other runs' are never touched
+    # Output format: csv (default) or parquet
+    output_format = os.getenv("TRANSFORM_FORMAT", "csv")
+    max_workers = int(os.getenv("TRANSFORM_WORKERS", os.cpu_count() or 1))
+    chunksize = int(os.getenv("TRANSFORM_CHUNKSIZE", 0)) or None
+    context.log.info(f"Starting file conversions for: {extract_folder} to {output_format} with {max_workers} workers")
+    with stage_metrics(context, "transformations") as stage:
+        # Convert glm files across worker processes
+        start = time.perf_counter()
+        results = transform_files(extract_folder, transform_folder, glm_files, max_workers, chunksize, output_format, context)
+        elapsed = time.perf_counter() - start
+        failed = results[results["status"] == "error"]
+        for filename, error in zip(failed["filename"], failed["error"]):
+            context.log.warning(f"Failed to convert {filename}: {error}")
+        converted = list(results.loc[results["status"] == "transformed", "filename"])
+        mark(conn, converted, "transformed")
+        conn.close()
+        stage.update({
+            "files": len(results),
+            "bytes_in": sum(os.path.getsize(os.path.join(extract_folder, f"{f}.ext")) for f in converted),
+            "bytes_out": sum(os.path.getsize(os.path.join(transform_folder, f)) for f in os.listdir(transform_folder) if f.endswith(".csv") or f.endswith(".parquet")),
+            "transformed": len(converted),
+            "failed": len(failed),
+            "files_per_sec": round(len(converted) / elapsed, 2) if elapsed > 0 else 0.0,
+            "latencies": list(results["seconds"]),
+        })
     return results
 
-@asset(group_name="ETL", description="Load GOES csv files into duckdb.", compute_kind="db load", retry_policy=RetryPolicy(max_retries=3, delay=10))
-def destination(context, transformations):
+@asset(group_name="ETL", description="Load GOES csv or parquet files into the duckdb flash table.", compute_kind="db load", partitions_def=hourly_partitions, retry_policy=RetryPolicy(max_retries=3, delay=10))
+def destination(context, transformations, duckdb: DuckDBResource):
     # config file string
-    transform_folder, bucket_name, load_folder = etl_config(process="load")
-    glm_files =  [f for f in os.listdir(transform_folder) if f.endswith(".csv") ]
+    transform_folder, bucket_name, load_folder = etl_config(process="load", hour=partition_hour(context), run_id=context.run.run_id)
+    glm_files =  [f for f in os.listdir(transform_folder) if f.endswith(".csv") or f.endswith(".parquet") ]
     context.log.info(f"Starting files load for: {transform_folder}")
-    # Navigate to folder
-    os.chdir(transform_folder)
-    for filename in glm_files:
+    with stage_metrics(context, "destination") as stage:
+        stage["files"] = len(glm_files)
+        stage["bytes_in"] = sum(os.path.getsize(os.path.join(transform_folder, f)) for f in glm_files)
+        for filename in glm_files:
+            try:
+                # Copy to folder
+                shutil.copy(os.path.join(transform_folder, filename), load_folder)
+                os.rename(os.path.join(transform_folder, filename), os.path.join(transform_folder, f"{filename}.trm"))
+            # If source and destination are same
+            except shutil.SameFileError:
+                context.log.info("Source and destination represents the same file.")
+            # If there is any permission issue
+            except PermissionError:
+                context.log.info("Permission denied.")
+            # For other errors
+            except:
+                context.log.info(f"Error copying {filename} to {load_folder}.")
+        context.log.info(f"Loading {load_folder} bulk files to db.")
+        conn_db = duckdb.get_connection("flash")
+        results = load(load_folder, context, conn=conn_db)
+        conn_db.close()
         try:
-            # Copy to folder
-            shutil.copy(filename, load_folder)
-            os.rename(filename, f"{filename}.trm")
-        # If source and destination are same
-        except shutil.SameFileError:
-            context.log.info("Source and destination represents the same file.")
-        # If there is any permission issue
-        except PermissionError:
-            context.log.info("Permission denied.")
-        # For other errors
-        except:
-            context.log.info(f"Error copying {filename} to {load_folder}.")
-    results = []
-    context.log.info(f"Loading {load_folder} bulk files to db.")
-    db_load = load(load_folder, context)
-    results.append(db_load)
-    return results
\ No newline at end of file
+            # Loaded files are removed, drop the run's staging folder once empty
+            os.rmdir(load_folder)
+        except OSError:
+            pass
+        stage["granules"] = len(results)
+        stage["rows_out"] = int(results["rows"].sum())
+        # Granules whose files were loaded, including ones already in the ledger
+        conn = manifest_connect(manifest_config())
+        mark(conn, sorted({f"{f.split('.')[0]}.nc" for f in glm_files}), "loaded")
+        conn.close()
+    return results
+
+@asset(group_name="ETL", description="Aggregate loaded flashes into a grid cell x time bin cube for map queries.", compute_kind="db aggregate", partitions_def=hourly_partitions, retry_policy=RetryPolicy(max_retries=3, delay=10))
+def flash_grid(context, destination, duckdb: DuckDBResource):
+    # Grid resolution in degrees and time bin in minutes
+    grid_deg = float(os.getenv("GRID_DEG", 0.1))
+    bin_minutes = int(os.getenv("GRID_BIN_MINUTES", 5))
+    hour = partition_hour(context) or datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    with stage_metrics(context, "flash_grid") as stage:
+        conn_db = duckdb.get_connection("flash")
+        # Granules of this hour, loaded by destination or streamed by source
+        granules = hour_granules(conn_db, hour)
+        context.log.info(f"Updating {grid_deg} deg x {bin_minutes} min grid for {len(granules)} granules of {hour}")
+        updated = update_grid(conn_db, granules, grid_deg, bin_minutes, context)
+        conn_db.close()
+        stage["files"] = len(granules)
+        stage["bins"] = len(updated)
+        stage["rows_out"] = int(updated["cells"].sum())
+    return updated
+
+@asset(group_name="Maintenance", description="Archive old flashes to partitioned parquet, compact the flash database and remove loaded intermediate files.", compute_kind="db maintenance")
+def maintenance(context, duckdb: DuckDBResource):
+    # Days of flashes kept in the live table, and of grid bins
+    retention_days = int(os.getenv("RETENTION_DAYS", 30))
+    grid_retention_days = int(os.getenv("GRID_RETENTION_DAYS", retention_days))
+    # Rewrite the database file to reclaim the space of archived rows
+    compact = os.getenv("MAINTENANCE_COMPACT", "0") == "1"
+    now = datetime.utcnow()
+    with stage_metrics(context, "maintenance") as stage:
+        conn_db = duckdb.get_connection("flash")
+        create_flash_tables(conn_db)
+        archived = archive_flashes(conn_db, archive_config(), now - timedelta(days=retention_days), context)
+        context.log.info(f"Archived {int(archived['rows'].sum()) if len(archived) else 0} flashes in {len(archived)} hours to {archive_config()}")
+        grid_rows = prune_grid(conn_db, now - timedelta(days=grid_retention_days))
+        loaded = {source_file for (source_file,) in conn_db.execute("SELECT source_file FROM loaded_files;").fetchall()}
+        conn_db.close()
+        # Intermediate files of loaded granules
+        removed = collect_garbage([os.path.join(data_folder(), "Extract"), os.path.join(data_folder(), "transform")], loaded, context)
+        context.log.info(f"Removed {len(removed)} intermediate files, {int(removed['bytes'].sum())} bytes")
+        stage.update({
+            "rows_out": int(archived["rows"].sum()) if len(archived) else 0,
+            "archived_hours": len(archived),
+            "grid_rows_pruned": int(grid_rows),
+            "files": len(removed),
+            "bytes_in": int(removed["bytes"].sum()),
+        })
+        if compact:
+            import duckdb as db
+            # Compaction needs the only connection to the file
+            duckdb.close("flash")
+            try:
+                stats = compact_database(duckdb.path("flash"))
+                context.log.info(f"Compacted flash database: {stats}")
+                stage.update(stats)
+            except db.IOException as e:
+                context.log.warning(f"Flash database in use, skipping compaction: {e}")
+        else:
+            duckdb.checkpoint("flash")
+    return archived
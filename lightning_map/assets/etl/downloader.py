@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import os
+import time
+import hashlib
+
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def s3_client(max_pool_connections: int=10):
+    """
+    Shared unsigned s3 client, the connection pool is sized to the number of download workers
+    """
+    # boto3 is imported on first use, it is slow to import and code locations load without it
+    from boto3 import client
+    from botocore import UNSIGNED
+    from botocore.client import Config
+    config = Config(
+        signature_version=UNSIGNED,
+        max_pool_connections=max_pool_connections,
+        retries={"max_attempts": 5, "mode": "adaptive"},
+    )
+    return client('s3', config=config)
+
+def is_present(filepath: str, size: int=None, etag: str=None) -> bool:
+    """
+    Check whether a local file already matches the s3 object by size, or by ETag when no size is known
+    """
+    if not os.path.exists(filepath):
+        return False
+    if size is not None:
+        return os.path.getsize(filepath) == size
+    # Multipart ETags are not a plain md5 of the content
+    if etag and "-" not in etag:
+        with open(filepath, 'rb') as local_file:
+            return hashlib.md5(local_file.read()).hexdigest() == etag.strip('"')
+    return False
+
+def download_object(s3, bucket: str, key: str, dest_folder: str, size: int=None, etag: str=None) -> dict:
+    """
+    Download a single s3 object into dest_folder unless an identical copy is already there
+    """
+    filename = os.path.basename(key)
+    filepath = os.path.join(dest_folder, filename)
+    record = {"key": key, "filename": filename, "bytes": 0, "status": "skipped", "seconds": 0.0, "error": None}
+    if is_present(filepath, size, etag):
+        return record
+    from botocore import exceptions
+    start = time.perf_counter()
+    try:
+        s3.download_file(Bucket=bucket, Key=key, Filename=filepath)
+        record["status"] = "downloaded"
+        record["bytes"] = os.path.getsize(filepath)
+    except exceptions.ClientError as err:
+        record["status"] = "missing" if err.response['Error']['Code'] == "404" else "error"
+        record["error"] = str(err)
+    except Exception as err:
+        record["status"] = "error"
+        record["error"] = str(err)
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+def download_objects(s3, bucket: str, objects: list, dest_folder: str, max_workers: int=16, context: str=None) -> pd.DataFrame:
+    """
+    Download s3 objects concurrently with a bounded pool of workers.
+    objects = [{'Key': ..., 'Size': ..., 'ETag': ...}] as returned by the s3 listing
+    """
+    from tqdm import tqdm
+    records = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        jobs = [
+            executor.submit(download_object, s3, bucket, obj['Key'], dest_folder, obj.get('Size'), obj.get('ETag'))
+            for obj in objects
+        ]
+        for job in tqdm(as_completed(jobs), total=len(jobs), ascii=" >=", desc=f"Extract {bucket}"):
+            records.append(job.result())
+    columns = ["key", "filename", "bytes", "status", "seconds", "error"]
+    return pd.DataFrame(records, columns=columns)
+
+def transfer_stats(downloads: pd.DataFrame, elapsed: float) -> dict:
+    """
+    Summarize a download batch: counts, throughput and per-file latency
+    """
+    fetched = downloads[downloads["status"] == "downloaded"]
+    total_bytes = int(fetched["bytes"].sum())
+    stats = {
+        "files": len(downloads),
+        "downloaded": len(fetched),
+        "skipped": int((downloads["status"] == "skipped").sum()),
+        "failed": int(downloads["status"].isin(["missing", "error"]).sum()),
+        "bytes": total_bytes,
+        "elapsed_s": round(elapsed, 3),
+        "bytes_per_sec": round(total_bytes / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+    latency = fetched["seconds"]
+    for name, q in [("p50", 0.5), ("p95", 0.95), ("max", 1.0)]:
+        stats[f"latency_{name}_s"] = round(float(latency.quantile(q)), 4) if len(latency) else 0.0
+    return stats
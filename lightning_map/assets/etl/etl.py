@@ -1,51 +1,60 @@
 #!/usr/bin/env python
 
 import os
+import time
 import shutil
+import threading
 
-import netCDF4 as nc
+import numpy as np
 import pandas as pd
-import duckdb as db
 
-from botocore.client import Config
-from botocore import UNSIGNED, exceptions
-from boto3 import client
-from tqdm import tqdm
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
+from .downloader import s3_client, download_object
 
-def extract(bucket: str, prefix: str, filename: str,  filepath: str, context: str=None) -> pd.DataFrame:
+# The netCDF/HDF5 libraries are not thread safe, hours running in threads share this lock
+NETCDF_LOCK = threading.Lock()
+
+def extract(bucket: str, prefix: str, filename: str,  filepath: str, context: str=None, s3=None) -> pd.DataFrame:
     """
     Downloads GOES netCDF files from s3 buckets
     prefix = s3://<weather_satellite>/<product_line>/<year>/<day_of_year>/<hour>/<OR_...*.nc>
     """
-    s3 = client('s3', config=Config(signature_version=UNSIGNED))
-    try:
-        s3.download_file(Bucket=bucket,Filename=filename,Key=filepath)
-    except exceptions.ClientError as err:
-        if err.response['Error']['Code'] == "404":
-            print(f"{filename} cannot be located.")
-        else:
-            raise
-    # List files downloaded
-    df_extract = pd.DataFrame(os.listdir())
+    # Reuse the shared client unless one is given
+    s3 = s3 or s3_client()
+    record = download_object(s3, bucket, filepath, os.getcwd())
+    if record["status"] == "missing":
+        print(f"{filename} cannot be located.")
+    elif record["status"] == "error":
+        raise RuntimeError(record["error"])
+    # Downloaded file record
+    df_extract = pd.DataFrame([record])
     return df_extract
     
 
-def transform(extract_folder: str, transform_folder: str, filename: str, context: str=None) -> pd.DataFrame: 
+def transform(extract_folder: str, transform_folder: str, filename: str, context: str=None, output_format: str="csv") -> pd.DataFrame: 
     """
-    Convert GOES netCDF files into csv
+    Convert GOES netCDF files into csv, or one parquet file per granule
     """
     file_conn = Path(os.path.join(extract_folder, filename))
+    import netCDF4 as nc
+    # Create dataset, one reader at a time per process
+    with NETCDF_LOCK, nc.Dataset(file_conn, mode='r') as glm:
+        if output_format == "parquet":
+            flashes = decode_granule(glm)
+        else:
+            flash_lat = glm.variables['flash_lat'][:]
+            flash_lon = glm.variables['flash_lon'][:]
+            flash_energy = glm.variables['flash_energy'][:]
+            dtime = pd.DatetimeIndex(decode_time(glm.variables['flash_time_offset_of_first_event']))
+    if output_format == "parquet":
+        parquet_filename = Path(transform_folder) / file_conn.with_suffix('.parquet').name
+        write_parquet(parquet_filename, flashes)
+        return pd.DataFrame([parquet_filename.name])
     energy_filename = file_conn.with_suffix('').with_suffix('.ene.csv') # energy file
     lat_filename = file_conn.with_suffix('').with_suffix('.lat.csv') # latitude file
     lon_filename = file_conn.with_suffix('').with_suffix('.lon.csv') # longitude file
-    # Create dataset
-    glm =  nc.Dataset(file_conn, mode='r')
-    flash_lat = glm.variables['flash_lat'][:]
-    flash_lon = glm.variables['flash_lon'][:]
-    flash_time = glm.variables['flash_time_offset_of_first_event']
-    flash_energy = glm.variables['flash_energy'][:]
-    dtime = nc.num2date(flash_time[:],flash_time.units)
     # Flatten multi-dimensional data into series        
     flash_energy_ts = pd.Series(flash_energy, index=dtime)
     flash_lat_ts = pd.Series(flash_lat, index=dtime)
@@ -69,64 +78,295 @@ def transform(extract_folder: str, transform_folder: str, filename: str, context
     shutil.move(lat_filename, transform_folder) 
     shutil.move(lon_filename, transform_folder) 
     # List converted files
-    df_transform = pd.DataFrame(os.listdir())
+    df_transform = pd.DataFrame([energy_filename.name, lat_filename.name, lon_filename.name])
     return df_transform
 
-def load(load_folder: str, context: str=None) -> pd.DataFrame:
+def transform_batch(extract_folder: str, transform_folder: str, filenames: list, output_format: str="csv") -> list:
     """
-    Load GOES csv files into destination system
-    """ 
-    os.chdir(load_folder)
-    glm_files = [s for s in os.listdir() if s.endswith('.csv')]    
-    conn = db.connect(f"{load_folder}/glmFlash.db")
-    try:
-        # create the table "tbl_flash" from the csv files
-        conn.execute(f"""
-            CREATE TABLE tbl_flash 
-            AS 
-            SELECT 
-                *
-            FROM read_csv_auto('*.ene.csv', header=True, filename=True, types={{'ts_date': TIMESTAMP,'energy': DOUBLE}});
-            """)
-    except Exception as db_insert:
-        # table likely exist try insert
-        conn.execute(f"INSERT INTO tbl_flash SELECT * FROM read_csv_auto('*.ene.csv', header=True, filename=True);")
+    Transform a chunk of granules in a worker, recording each file's outcome instead of raising
+    """
+    records = []
+    for filename in filenames:
+        start = time.perf_counter()
+        record = {"filename": filename, "status": "transformed", "seconds": 0.0, "error": None}
+        try:
+            transform(extract_folder, transform_folder, filename, output_format=output_format)
+            # Mark granule as extracted and converted
+            os.rename(os.path.join(extract_folder, filename), os.path.join(extract_folder, f"{filename}.ext"))
+        except Exception as err:
+            record["status"] = "error"
+            record["error"] = f"{type(err).__name__}: {err}"
+        record["seconds"] = time.perf_counter() - start
+        records.append(record)
+    return records
+
+def transform_files(extract_folder: str, transform_folder: str, filenames: list, max_workers: int=1, chunksize: int=None, output_format: str="csv", context: str=None) -> pd.DataFrame:
+    """
+    Transform granules across a pool of worker processes, submitted in chunks.
+    A bad file is recorded as an error without aborting the rest of the batch.
+    """
+    columns = ["filename", "status", "seconds", "error"]
+    if not filenames:
+        return pd.DataFrame([], columns=columns)
+    if max_workers <= 1:
+        records = transform_batch(extract_folder, transform_folder, filenames, output_format)
+        return pd.DataFrame(records, columns=columns)
+    # Several chunks per worker keeps the pool busy when file sizes vary
+    chunksize = chunksize or max(1, len(filenames) // (max_workers * 4))
+    chunks = [filenames[i:i + chunksize] for i in range(0, len(filenames), chunksize)]
+    from tqdm import tqdm
+    records = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        jobs = {executor.submit(transform_batch, extract_folder, transform_folder, chunk, output_format): chunk for chunk in chunks}
+        with tqdm(total=len(filenames), desc=f"transform {extract_folder}") as progress:
+            for job in as_completed(jobs):
+                try:
+                    batch = job.result()
+                except Exception as err:
+                    # A crashed worker fails its whole chunk
+                    batch = [{"filename": f, "status": "error", "seconds": 0.0, "error": f"{type(err).__name__}: {err}"} for f in jobs[job]]
+                records.extend(batch)
+                progress.update(len(batch))
+    return pd.DataFrame(records, columns=columns)
 
+# Nanoseconds per CF time unit
+TIME_UNITS_NS = {
+    "days": 86_400_000_000_000, "day": 86_400_000_000_000,
+    "hours": 3_600_000_000_000, "hour": 3_600_000_000_000,
+    "minutes": 60_000_000_000, "minute": 60_000_000_000,
+    "seconds": 1_000_000_000, "second": 1_000_000_000, "s": 1_000_000_000,
+    "milliseconds": 1_000_000, "millisecond": 1_000_000, "ms": 1_000_000,
+    "microseconds": 1_000, "microsecond": 1_000, "us": 1_000,
+}
+
+@lru_cache(maxsize=64)
+def time_units(units: str) -> tuple:
+    """
+    Nanoseconds per unit and the epoch in nanoseconds of a CF 'units since epoch' string
+    """
+    unit, since, epoch = units.strip().split(" ", 2)
+    if since != "since" or unit.lower() not in TIME_UNITS_NS:
+        raise ValueError(f"Unsupported time units: {units}")
+    epoch = pd.Timestamp(epoch.strip().rstrip("Z"))
+    if epoch.tzinfo is not None:
+        epoch = epoch.tz_convert("UTC").tz_localize(None)
+    return TIME_UNITS_NS[unit.lower()], epoch.as_unit("ns").value
+
+def decode_time(variable) -> np.ndarray:
+    """
+    Decode a packed CF time offset variable into datetime64[ns] with NumPy arithmetic.
+    Unpacks the raw integers in float64, fill values become NaT; rounded to the microsecond like num2date.
+    Signed integers flagged _Unsigned, as GLM stores its offsets, are read as unsigned.
+    """
+    unit_ns, epoch_ns = time_units(variable.units)
+    # Read the packed integers, netCDF4 would unpack them to float32
+    variable.set_auto_maskandscale(False)
     try:
-        # create the table "tbl_flash_lat" from the csv files
-        conn.execute(f"""
-            CREATE TABLE tbl_flash_lat 
-            AS 
-            SELECT 
-                *
-            FROM read_csv_auto('*.lat.csv', header=True, filename=True, types={{'ts_date': TIMESTAMP,'lat': DOUBLE}});
-            """)
-    except Exception as db_insert:
-        # table likely exist try insert
-        conn.execute(f"INSERT INTO tbl_flash_lat SELECT * FROM read_csv_auto('*.lat.csv', header=True, filename=True);")
+        raw = np.asarray(variable[:])
+    finally:
+        variable.set_auto_maskandscale(True)
+    fill = np.zeros(raw.shape, dtype=bool)
+    for attribute in ["_FillValue", "missing_value"]:
+        if attribute in variable.ncattrs():
+            fill |= raw == getattr(variable, attribute)
+    # Fill values are compared in the stored type, then the bits are reinterpreted as unsigned
+    if str(getattr(variable, "_Unsigned", "false")).lower() == "true" and raw.dtype.kind == "i":
+        raw = raw.view(f"u{raw.dtype.itemsize}")
+    offsets = raw.astype("float64")
+    if "scale_factor" in variable.ncattrs():
+        offsets *= float(variable.scale_factor)
+    if "add_offset" in variable.ncattrs():
+        offsets += float(variable.add_offset)
+    offsets *= unit_ns / 1_000
+    ns = np.rint(offsets, out=offsets).astype("int64")
+    ns *= 1_000
+    ns += epoch_ns
+    ns[fill] = np.iinfo("int64").min
+    return ns.view("datetime64[ns]")
 
+def decode_granule(glm) -> pd.DataFrame:
+    """
+    Decode a GLM granule's flash variables into typed columns
+    """
+    flash_lat = glm.variables['flash_lat'][:]
+    flash_time = glm.variables['flash_time_offset_of_first_event']
+    flash_id = glm.variables['flash_id'][:] if 'flash_id' in glm.variables else np.arange(len(flash_lat))
+    flashes = pd.DataFrame({
+        "flash_id": np.ma.filled(np.ma.asarray(flash_id, dtype="int64"), -1),
+        "ts": decode_time(flash_time),
+        "lat": np.ma.filled(np.ma.asarray(flash_lat, dtype="float32"), np.nan),
+        "lon": np.ma.filled(np.ma.asarray(glm.variables['flash_lon'][:], dtype="float32"), np.nan),
+        "energy": np.ma.filled(np.ma.asarray(glm.variables['flash_energy'][:], dtype="float64"), np.nan),
+    })
+    return flashes
+
+def write_parquet(parquet_filename: str, flashes: pd.DataFrame, compression: str="zstd") -> None:
+    """
+    Write one granule of flashes as a typed, compressed parquet file
+    """
+    # Write to a temp name so a partial file is never loaded
+    tmp_filename = f"{parquet_filename}.tmp"
+    flashes.to_parquet(tmp_filename, engine="pyarrow", compression=compression, index=False)
+    os.replace(tmp_filename, parquet_filename)
+
+def fetch_object(s3, bucket: str, key: str) -> tuple:
+    """
+    Read an s3 object into memory, returning its bytes and the fetch time
+    """
+    start = time.perf_counter()
+    body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    return body, time.perf_counter() - start
+
+def stream_granule(body: bytes, filename: str) -> pd.DataFrame:
+    """
+    Decode a granule straight from its bytes, no file on disk
+    """
+    import netCDF4 as nc
+    with NETCDF_LOCK, nc.Dataset(filename, mode='r', memory=body) as glm:
+        flashes = decode_granule(glm)
+    flashes["source_file"] = filename
+    return flashes
+
+def stream_objects(s3, bucket: str, objects: list, max_workers: int=16, context: str=None) -> tuple:
+    """
+    Fetch s3 objects into memory concurrently and decode them as they arrive.
+    Decoding stays on the calling thread, the netCDF library is not thread safe.
+    Returns the decoded flashes and a per-object record of the fetch.
+    """
+    from tqdm import tqdm
+    frames = []
+    records = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        jobs = {executor.submit(fetch_object, s3, bucket, obj['Key']): obj['Key'] for obj in objects}
+        for job in tqdm(as_completed(jobs), total=len(jobs), ascii=" >=", desc=f"Stream {bucket}"):
+            key = jobs[job]
+            filename = os.path.basename(key)
+            record = {"key": key, "filename": filename, "bytes": 0, "status": "downloaded", "seconds": 0.0, "error": None}
+            try:
+                body, record["seconds"] = job.result()
+                record["bytes"] = len(body)
+                frames.append(stream_granule(body, filename))
+            except Exception as err:
+                record["status"] = "error"
+                record["error"] = f"{type(err).__name__}: {err}"
+            records.append(record)
+    columns = ["flash_id", "ts", "lat", "lon", "energy", "source_file"]
+    flashes = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame([], columns=columns)
+    return flashes, pd.DataFrame(records, columns=["key", "filename", "bytes", "status", "seconds", "error"])
+
+def create_flash_tables(conn, retries: int=5) -> None:
+    """
+    Create the wide flash table and the ledger of loaded granules.
+    Hours loading concurrently can race on the first create, the loser retries and finds the tables.
+    """
+    import duckdb as db
+    for attempt in range(retries):
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS flash (
+                    flash_id BIGINT,
+                    ts TIMESTAMP,
+                    lat DOUBLE,
+                    lon DOUBLE,
+                    energy DOUBLE,
+                    source_file VARCHAR
+                );
+                CREATE TABLE IF NOT EXISTS loaded_files (
+                    source_file VARCHAR PRIMARY KEY,
+                    rows BIGINT,
+                    loaded_at TIMESTAMP
+                );
+                """)
+            return
+        except db.TransactionException:
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.1 * (attempt + 1))
+
+def read_csv_granule(load_folder: str, granule: str) -> pd.DataFrame:
+    """
+    Rebuild one granule's flashes from its energy, lat and lon csv files.
+    The three files are written from the same arrays, so rows line up by position.
+    """
+    columns = {}
+    for suffix, column in [("ene", "energy"), ("lat", "lat"), ("lon", "lon")]:
+        series = pd.read_csv(os.path.join(load_folder, f"{granule}.{suffix}.csv"), parse_dates=['ts_date'])
+        columns["ts"] = series['ts_date']
+        columns[column] = series[column]
+    flashes = pd.DataFrame(columns)
+    flashes.insert(0, "flash_id", range(len(flashes)))
+    flashes["source_file"] = f"{granule}.nc"
+    return flashes[["flash_id", "ts", "lat", "lon", "energy", "source_file"]]
+
+def append_staged(conn) -> list:
+    """
+    Append the staged new_flash rows to the flash table and the ledger in one transaction
+    """
+    conn.execute("BEGIN TRANSACTION;")
     try:
-        # create the table "tbl_flash_lon" from the csv files
-        conn.execute(f"""
-            CREATE TABLE tbl_flash_lon 
-            AS 
-            SELECT 
-                *
-            FROM read_csv_auto('*.lon.csv', header=True, filename=True, types={{'ts_date': TIMESTAMP,'lon': DOUBLE}});
+        # Ordered by time so row group zone maps prune hourly queries
+        conn.execute("INSERT INTO flash SELECT * FROM new_flash ORDER BY ts;")
+        # Record loaded granules in the ledger
+        conn.execute("""
+            INSERT INTO loaded_files
+            SELECT source_file, count(*), now() FROM new_flash GROUP BY source_file;
             """)
-    except Exception as db_insert:
-        # table likely exist try insert
-        conn.execute(f"INSERT INTO tbl_flash_lon SELECT * FROM read_csv_auto('*.lon.csv', header=True, filename=True);")
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    new_files = [source_file for (source_file,) in conn.execute("SELECT DISTINCT source_file FROM new_flash;").fetchall()]
+    conn.execute("DROP TABLE new_flash;")
+    return new_files
 
-    os.makedirs('loaded')
-    # try:
+def load_frames(load_folder: str, flashes: pd.DataFrame, context: str=None, conn=None) -> pd.DataFrame:
+    """
+    Load decoded flashes straight into the flash table, skipping granules already loaded
+    """
+    import duckdb as db
+    conn = conn or db.connect(os.path.join(load_folder, "glmFlash.db"))
+    create_flash_tables(conn)
+    conn.execute("CREATE OR REPLACE TEMP TABLE new_flash AS SELECT * FROM flash LIMIT 0;")
+    conn.execute("""
+        INSERT INTO new_flash
+        SELECT flash_id, ts, lat, lon, energy, source_file FROM flashes
+        WHERE source_file NOT IN (SELECT source_file FROM loaded_files);
+        """)
+    new_files = append_staged(conn)
+    # List files loaded
+    df_load = conn.execute("SELECT * FROM loaded_files WHERE list_contains(?, source_file);", [new_files]).df()
+    return df_load
+
+def load(load_folder: str, context: str=None, conn=None) -> pd.DataFrame:
+    """
+    Load GOES csv or parquet files into the flash table.
+    Granules already in the loaded_files ledger are skipped, so reloading is idempotent.
+    """ 
+    import duckdb as db
+    glm_files = [s for s in os.listdir(load_folder) if s.endswith('.csv') or s.endswith('.parquet')]    
+    conn = conn or db.connect(os.path.join(load_folder, "glmFlash.db"))
+    create_flash_tables(conn)
+    loaded = {source_file for (source_file,) in conn.execute("SELECT source_file FROM loaded_files;").fetchall()}
+    # Granule name is the netCDF file name the outputs came from
+    parquet_files = [os.path.join(load_folder, s) for s in glm_files if s.endswith('.parquet') and f"{s.split('.')[0]}.nc" not in loaded]
+    parquet_granules = {os.path.basename(f).split('.')[0] for f in parquet_files}
+    csv_granules = sorted({s.split('.')[0] for s in glm_files if s.endswith('.csv') and f"{s.split('.')[0]}.nc" not in loaded} - parquet_granules)
+    # Stage new granules, then append them in one ordered bulk insert
+    conn.execute("CREATE OR REPLACE TEMP TABLE new_flash AS SELECT * FROM flash LIMIT 0;")
+    if parquet_files:
+        # Straight from the columnar granules
+        conn.execute("""
+            INSERT INTO new_flash
+            SELECT flash_id, ts, lat, lon, energy, parse_filename(filename, true) || '.nc' AS source_file
+            FROM read_parquet(?, filename=true);
+            """, [parquet_files])
+    if csv_granules:
+        csv_flashes = pd.concat([read_csv_granule(load_folder, granule) for granule in csv_granules])
+        conn.execute("INSERT INTO new_flash SELECT * FROM csv_flashes;")
+    new_files = append_staged(conn)
+    # cleanup loaded files
     for filename in glm_files:
-        # Move loaded files
-        shutil.move(filename, "loaded")
-    # except Exception as e:
-        # print("Exception errors received.")
-    # cleanup
-    shutil.rmtree('loaded')
+        os.remove(os.path.join(load_folder, filename))
     # List files loaded
-    df_load = conn.execute("SHOW TABLES;").df()
-    return df_load
\ No newline at end of file
+    df_load = conn.execute("SELECT * FROM loaded_files WHERE list_contains(?, source_file);", [new_files]).df()
+    return df_load
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import time
+
+import pandas as pd
+
+from datetime import datetime, timedelta
+
+def create_grid_table(conn, retries: int=5) -> None:
+    """
+    Create the flash grid cube: flash counts and energy per grid cell and time bin
+    """
+    import duckdb as db
+    for attempt in range(retries):
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS flash_grid (
+                    grid_deg DOUBLE,
+                    bin_minutes INTEGER,
+                    bin_start TIMESTAMP,
+                    cell_row INTEGER,
+                    cell_col INTEGER,
+                    flashes BIGINT,
+                    energy_sum DOUBLE,
+                    energy_max DOUBLE
+                );
+                """)
+            return
+        except db.TransactionException:
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.1 * (attempt + 1))
+
+def hour_granules(conn, hour: datetime) -> list:
+    """
+    Granules in the loaded_files ledger whose scan started in the given hour
+    """
+    # GLM file names carry the scan start as _sYYYYJJJHHMMSSt
+    pattern = f"%\\_s{hour.strftime('%Y%j%H')}%"
+    rows = conn.execute("SELECT source_file FROM loaded_files WHERE source_file LIKE ? ESCAPE '\\';", [pattern]).fetchall()
+    return [source_file for (source_file,) in rows]
+
+def update_grid(conn, source_files: list, grid_deg: float=0.1, bin_minutes: int=5, context: str=None) -> pd.DataFrame:
+    """
+    Rebuild the grid bins touched by the flashes of newly loaded source_files.
+    Touched bins are recomputed from every flash in them, so reruns and late granules stay exact.
+    """
+    create_grid_table(conn)
+    if not source_files:
+        return pd.DataFrame([], columns=["bin_start", "cells"])
+    span = conn.execute("""
+        SELECT
+            time_bucket(to_minutes($bin_minutes), min(ts)) AS first_bin,
+            time_bucket(to_minutes($bin_minutes), max(ts)) + to_minutes($bin_minutes) AS last_bin
+        FROM flash
+        WHERE list_contains($files, source_file);
+        """, {"bin_minutes": bin_minutes, "files": list(source_files)}).fetchone()
+    first_bin, last_bin = span
+    if first_bin is None:
+        return pd.DataFrame([], columns=["bin_start", "cells"])
+    params = {"grid_deg": grid_deg, "bin_minutes": bin_minutes, "first_bin": first_bin, "last_bin": last_bin}
+    conn.execute("BEGIN TRANSACTION;")
+    try:
+        conn.execute("""
+            DELETE FROM flash_grid
+            WHERE grid_deg = $grid_deg AND bin_minutes = $bin_minutes
+                AND bin_start >= $first_bin AND bin_start < $last_bin;
+            """, params)
+        # Time range filter on flash is pruned by the row group zone maps
+        conn.execute("""
+            INSERT INTO flash_grid
+            SELECT
+                $grid_deg,
+                $bin_minutes,
+                time_bucket(to_minutes($bin_minutes), ts) AS bin_start,
+                CAST(floor(lat / $grid_deg) AS INTEGER) AS cell_row,
+                CAST(floor(lon / $grid_deg) AS INTEGER) AS cell_col,
+                count(*),
+                sum(energy),
+                max(energy)
+            FROM flash
+            WHERE ts >= $first_bin AND ts < $last_bin AND lat IS NOT NULL AND lon IS NOT NULL
+            GROUP BY ALL
+            ORDER BY bin_start;
+            """, params)
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    updated = conn.execute("""
+        SELECT bin_start, count(*) AS cells FROM flash_grid
+        WHERE grid_deg = $grid_deg AND bin_minutes = $bin_minutes
+            AND bin_start >= $first_bin AND bin_start < $last_bin
+        GROUP BY bin_start ORDER BY bin_start;
+        """, params).df()
+    return updated
+
+def prune_grid(conn, cutoff: datetime) -> int:
+    """
+    Drop grid bins older than cutoff, returning the rows removed
+    """
+    create_grid_table(conn)
+    (removed,) = conn.execute("DELETE FROM flash_grid WHERE bin_start < ?;", [cutoff]).fetchone()
+    return removed
+
+def query_grid(conn, start: datetime, end: datetime, lat_min: float=-90, lat_max: float=90, lon_min: float=-180, lon_max: float=180, grid_deg: float=0.1, bin_minutes: int=5) -> pd.DataFrame:
+    """
+    Flash counts and energy per grid cell for a region and time window, from the cube only.
+    Cells are returned by their south-west corner; bins overlapping [start, end) are included.
+    """
+    region = conn.execute("""
+        SELECT
+            cell_row * $grid_deg AS lat,
+            cell_col * $grid_deg AS lon,
+            sum(flashes) AS flashes,
+            sum(energy_sum) AS energy_sum,
+            max(energy_max) AS energy_max
+        FROM flash_grid
+        WHERE grid_deg = $grid_deg AND bin_minutes = $bin_minutes
+            AND bin_start > $start - to_minutes($bin_minutes) AND bin_start < $end
+            AND cell_row BETWEEN CAST(floor($lat_min / $grid_deg) AS INTEGER) AND CAST(floor($lat_max / $grid_deg) AS INTEGER)
+            AND cell_col BETWEEN CAST(floor($lon_min / $grid_deg) AS INTEGER) AND CAST(floor($lon_max / $grid_deg) AS INTEGER)
+        GROUP BY cell_row, cell_col
+        ORDER BY flashes DESC;
+        """, {
+            "grid_deg": grid_deg, "bin_minutes": bin_minutes, "start": start, "end": end,
+            "lat_min": lat_min, "lat_max": lat_max, "lon_min": lon_min, "lon_max": lon_max,
+        }).df()
+    return region
+
+def recent_grid(conn, hours: int=1, **region) -> pd.DataFrame:
+    """
+    Flash counts and energy per grid cell for the last N hours
+    """
+    end = datetime.utcnow()
+    return query_grid(conn, end - timedelta(hours=hours), end, **region)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import os
+import time
+
+import pandas as pd
+
+# Processing states, in pipeline order
+STATES = ["listed", "extracted", "transformed", "loaded"]
+
+def list_objects(s3, bucket: str, prefix: str, start_after: str=None):
+    """
+    List every object under prefix, following s3 pagination past the 1000 key page limit.
+    With start_after, only keys sorting after it are listed.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    kwargs = {"StartAfter": start_after} if start_after else {}
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, **kwargs):
+        # Empty prefixes have no 'Contents'
+        for obj in page.get('Contents', []):
+            yield obj
+
+def manifest_connect(manifest_path: str, retries: int=5):
+    """
+    Open the manifest database, creating the manifest table if missing.
+    Hours running concurrently can race on the first create, the loser retries and finds the table.
+    """
+    import duckdb as db
+    conn = db.connect(manifest_path)
+    for attempt in range(retries):
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS manifest (
+                    key VARCHAR PRIMARY KEY,
+                    prefix VARCHAR,
+                    filename VARCHAR,
+                    size BIGINT,
+                    etag VARCHAR,
+                    state VARCHAR,
+                    updated_at TIMESTAMP
+                );
+                """)
+            break
+        except db.TransactionException:
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.1 * (attempt + 1))
+    return conn
+
+def sync_manifest(conn, prefix: str, objects: list) -> int:
+    """
+    Record listed objects for prefix, new keys or keys whose ETag changed restart as 'listed'
+    """
+    listing = pd.DataFrame(
+        [(obj['Key'], prefix, os.path.basename(obj['Key']), obj.get('Size'), obj.get('ETag', '').strip('"')) for obj in objects],
+        columns=["key", "prefix", "filename", "size", "etag"],
+    )
+    if listing.empty:
+        return 0
+    conn.execute("""
+        INSERT INTO manifest
+        SELECT key, prefix, filename, size, etag, 'listed', now() FROM listing
+        ON CONFLICT (key) DO UPDATE SET
+            state = CASE WHEN manifest.etag = excluded.etag THEN manifest.state ELSE 'listed' END,
+            updated_at = CASE WHEN manifest.etag = excluded.etag THEN manifest.updated_at ELSE excluded.updated_at END,
+            size = excluded.size,
+            etag = excluded.etag;
+        """)
+    return len(listing)
+
+def pending(conn, prefix: str, state: str) -> list:
+    """
+    Objects under prefix that have not yet reached state, in the s3 listing shape
+    """
+    earlier = STATES[:STATES.index(state)]
+    rows = conn.execute(
+        "SELECT key, size, etag FROM manifest WHERE prefix = ? AND list_contains(?, state) ORDER BY key;",
+        [prefix, earlier],
+    ).fetchall()
+    return [{'Key': key, 'Size': size, 'ETag': etag} for key, size, etag in rows]
+
+def processed(conn, state: str) -> set:
+    """
+    Filenames that have reached state or later
+    """
+    later = STATES[STATES.index(state):]
+    rows = conn.execute("SELECT filename FROM manifest WHERE list_contains(?, state);", [later]).fetchall()
+    return {filename for (filename,) in rows}
+
+def mark(conn, filenames: list, state: str) -> None:
+    """
+    Advance the processing state for filenames
+    """
+    if not filenames:
+        return
+    conn.execute(
+        "UPDATE manifest SET state = ?, updated_at = now() WHERE list_contains(?, filename);",
+        [state, list(filenames)],
+    )
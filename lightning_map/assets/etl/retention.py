@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import os
+import uuid
+import glob
+
+import pandas as pd
+
+from datetime import datetime
+
+def archive_flashes(conn, archive_folder: str, cutoff: datetime, context: str=None) -> pd.DataFrame:
+    """
+    Move flashes older than cutoff out of the live table into Parquet partitioned
+    hive-style by year/doy/hour under archive_folder. Returns the rows archived per hour.
+    """
+    os.makedirs(archive_folder, exist_ok=True)
+    archived = conn.execute("""
+        SELECT year(ts) AS year, dayofyear(ts) AS doy, hour(ts) AS hour, count(*) AS rows
+        FROM flash WHERE ts < $cutoff
+        GROUP BY ALL ORDER BY ALL;
+        """, {"cutoff": cutoff}).df()
+    if archived.empty:
+        return archived
+    # Files of this run get their own prefix, so a failed run can remove exactly what it wrote
+    batch = f"flash_{uuid.uuid4().hex[:12]}"
+    conn.execute("BEGIN TRANSACTION;")
+    try:
+        conn.execute(f"""
+            COPY (
+                SELECT *, year(ts) AS year, dayofyear(ts) AS doy, hour(ts) AS hour
+                FROM flash WHERE ts < $cutoff
+                ORDER BY ts
+            ) TO '{archive_folder}' (
+                FORMAT parquet, COMPRESSION zstd, PARTITION_BY (year, doy, hour),
+                APPEND, FILENAME_PATTERN '{batch}_{{uuid}}'
+            );
+            """, {"cutoff": cutoff})
+        conn.execute("DELETE FROM flash WHERE ts < $cutoff;", {"cutoff": cutoff})
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        for path in glob.glob(os.path.join(archive_folder, "**", f"{batch}_*.parquet"), recursive=True):
+            os.remove(path)
+        raise
+    return archived
+
+def archived_flashes(conn, archive_folder: str, start: datetime, end: datetime) -> pd.DataFrame:
+    """
+    Flashes archived for [start, end), reading only the hour partitions in the window
+    """
+    if not glob.glob(os.path.join(archive_folder, "**", "*.parquet"), recursive=True):
+        return pd.DataFrame([], columns=["flash_id", "ts", "lat", "lon", "energy", "source_file"])
+    # Filters on the partition columns alone prune whole files before any is opened
+    flashes = conn.execute(f"""
+        SELECT flash_id, ts, lat, lon, energy, source_file
+        FROM read_parquet('{os.path.join(archive_folder, "**", "*.parquet")}', hive_partitioning = true)
+        WHERE (year * 1000 + doy) * 100 + hour BETWEEN $first AND $last
+            AND ts >= $start AND ts < $end
+        ORDER BY ts;
+        """, {"first": hour_key(start), "last": hour_key(end), "start": start, "end": end}).df()
+    return flashes
+
+def hour_key(dt: datetime) -> int:
+    # Sortable year, day of year and hour of a timestamp, as the archive partitions it
+    return (dt.year * 1000 + dt.timetuple().tm_yday) * 100 + dt.hour
+
+def compact_database(path: str) -> dict:
+    """
+    Rewrite a database into a fresh file, reclaiming the space of deleted rows.
+    Needs the only connection to the file, close the others first. The file lock is held
+    until the fresh file has replaced the live one, so no writer in another process can
+    open the old file and lose its writes in the swap.
+    """
+    import duckdb as db
+    compacted = f"{path}.compact"
+    if os.path.exists(compacted):
+        os.remove(compacted)
+    # Opening read-write takes the exclusive lock, raises IOException while another process has the file
+    conn = db.connect(path)
+    try:
+        # Fold the WAL in, a WAL left next to the fresh file would be replayed into it
+        conn.execute("CHECKPOINT;")
+        before = os.path.getsize(path)
+        live = conn.execute("SELECT current_database();").fetchone()[0]
+        conn.execute(f"ATTACH '{compacted}' AS compacted;")
+        conn.execute(f'COPY FROM DATABASE "{live}" TO compacted;')
+        conn.execute("DETACH compacted;")
+        os.replace(compacted, path)
+    except Exception:
+        if os.path.exists(compacted):
+            os.remove(compacted)
+        raise
+    finally:
+        # Nothing was written through this connection, closing it leaves the fresh file alone
+        conn.close()
+    return {"bytes_before": before, "bytes_after": os.path.getsize(path)}
+
+def granule_of(filename: str) -> str:
+    # <granule>.nc.ext, <granule>.parquet.trm, <granule>.ene.csv.trm -> <granule>.nc
+    return f"{filename.split('.')[0]}.nc"
+
+def collect_garbage(folders: list, loaded: set, context: str=None) -> pd.DataFrame:
+    """
+    Remove the renamed .ext and .trm intermediate files of granules already loaded,
+    then any folder left empty. Returns the files removed and their sizes.
+    """
+    removed = []
+    for folder in folders:
+        for root, dirs, files in os.walk(folder, topdown=False):
+            for filename in files:
+                if filename.endswith((".ext", ".trm")) and granule_of(filename) in loaded:
+                    path = os.path.join(root, filename)
+                    removed.append({"path": path, "bytes": os.path.getsize(path)})
+                    os.remove(path)
+            if root != folder and not os.listdir(root):
+                os.rmdir(root)
+    return pd.DataFrame(removed, columns=["path", "bytes"])
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import os
+import time
+import resource
+
+import numpy as np
+
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from dagster import MetadataValue
+
+# Upper bounds (seconds) of the per-file latency histogram buckets
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0]
+# Standard counters every stage can report
+COUNTERS = ["rows_in", "rows_out", "bytes_in", "bytes_out", "files"]
+
+def metrics_config():
+    # Pipeline metrics database
+    basepath = Path(__file__).resolve().parent.parent.parent
+    dest_folder = os.path.join(basepath, "data")
+    if not os.path.exists(dest_folder):
+        os.makedirs(dest_folder)
+    return os.path.join(dest_folder, "pipelineMetrics.db")
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident memory of this process or its worker processes, in MB
+    """
+    # ru_maxrss is reported in KB on linux
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak / 1024, 1)
+
+def latency_histogram(latencies: list) -> dict:
+    """
+    Percentiles and bucket counts of per-file latencies
+    """
+    if not len(latencies):
+        return {}
+    values = np.asarray(latencies, dtype="float64")
+    counts, _ = np.histogram(values, bins=[0.0] + LATENCY_BUCKETS + [np.inf])
+    labels = [f"<={b}s" for b in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+    return {
+        "latency_p50_s": round(float(np.quantile(values, 0.5)), 4),
+        "latency_p95_s": round(float(np.quantile(values, 0.95)), 4),
+        "latency_max_s": round(float(values.max()), 4),
+        "latency_histogram": dict(zip(labels, counts.tolist())),
+    }
+
+def record_metrics(row: dict, metrics_path: str=None, retries: int=5) -> None:
+    """
+    Append one stage's metrics to the pipeline_metrics table.
+    Stages running in parallel processes contend for the database lock, so retry briefly.
+    """
+    import duckdb as db
+    metrics_path = metrics_path or metrics_config()
+    for attempt in range(retries):
+        try:
+            conn = db.connect(metrics_path)
+            break
+        except db.IOException:
+            time.sleep(0.2 * (attempt + 1))
+    else:
+        raise RuntimeError(f"Could not lock {metrics_path} to record metrics")
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS pipeline_metrics (
+                run_id VARCHAR,
+                stage VARCHAR,
+                status VARCHAR,
+                started_at TIMESTAMP,
+                elapsed_s DOUBLE,
+                rows_in BIGINT,
+                rows_out BIGINT,
+                bytes_in BIGINT,
+                bytes_out BIGINT,
+                files BIGINT,
+                peak_rss_mb DOUBLE,
+                latency_p50_s DOUBLE,
+                latency_p95_s DOUBLE,
+                latency_max_s DOUBLE
+            );
+            """)
+        # Bound parameters rather than a DataFrame scan, which is not safe across threads sharing the database
+        columns = list(row)
+        conn.execute(
+            f"INSERT INTO pipeline_metrics ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)});",
+            [row[c] for c in columns],
+        )
+    finally:
+        conn.close()
+
+@contextmanager
+def stage_metrics(context, stage: str, metrics_path: str=None):
+    """
+    Time a stage and collect what it reports into the yielded dict: the COUNTERS,
+    'latencies' (per-file seconds) and any other key as extra asset metadata.
+    On exit the metrics are attached with context.add_output_metadata and appended
+    to the pipeline_metrics table.
+    """
+    metrics = {"latencies": []}
+    started_at = datetime.utcnow()
+    start = time.perf_counter()
+    status = "failed"
+    try:
+        yield metrics
+        status = "success"
+    finally:
+        elapsed = time.perf_counter() - start
+        latencies = metrics.pop("latencies")
+        histogram = latency_histogram(latencies)
+        summary = {"elapsed_s": round(elapsed, 3), "peak_rss_mb": peak_rss_mb()}
+        summary.update({k: int(metrics[k]) for k in COUNTERS if k in metrics})
+        summary.update({k: v for k, v in histogram.items() if k != "latency_histogram"})
+        row = {"run_id": context.run.run_id, "stage": stage, "status": status, "started_at": started_at}
+        row.update(summary)
+        try:
+            record_metrics(row, metrics_path)
+        except Exception as err:
+            # Metrics never fail the stage
+            context.log.warning(f"Could not record {stage} metrics: {err}")
+        if status == "success":
+            metadata = dict(summary)
+            metadata.update({k: v for k, v in metrics.items() if k not in COUNTERS})
+            if histogram:
+                metadata["latency_histogram"] = MetadataValue.json(histogram["latency_histogram"])
+            context.add_output_metadata(metadata)
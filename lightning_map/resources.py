@@ -0,0 +1,118 @@
+import os
+import time
+
+from dagster import ConfigurableResource, InitResourceContext
+from pydantic import PrivateAttr
+
+# Pipeline databases, relative to the data folder
+DATABASES = {
+    "flash": os.path.join("Load", "glmFlash.db"),
+    "clusters": "flashClusters.db",
+}
+
+class DuckDBResource(ConfigurableResource):
+    """
+    Owns the pipeline's DuckDB databases for a run: absolute paths, engine settings,
+    one read-write connection per database reused by every asset of the run, and read-only
+    connections for readers. Databases are checkpointed when the run ends so the WAL does not grow.
+    """
+    # Defaults to the project data folder
+    data_folder: str = ""
+    # 0 / "" keep the DuckDB defaults
+    threads: int = 0
+    memory_limit: str = ""
+    # WAL size that triggers an automatic checkpoint
+    checkpoint_threshold: str = "16MB"
+    # Attempts to open a database another process holds the lock on
+    lock_retries: int = 10
+
+    _connections: dict = PrivateAttr(default_factory=dict)
+
+    def setup_for_execution(self, context: InitResourceContext) -> None:
+        self._connections = {}
+
+    def teardown_after_execution(self, context: InitResourceContext) -> None:
+        for name in list(self._connections):
+            self.close(name)
+
+    def path(self, name: str) -> str:
+        """
+        Absolute path of a pipeline database, creating its folder if needed
+        """
+        if name not in DATABASES:
+            raise ValueError(f"Database {name} not found!")
+        if self.data_folder:
+            folder = self.data_folder
+        else:
+            # Imported here, the assets import this module
+            from .assets.etl import data_folder
+            folder = data_folder()
+        path = os.path.abspath(os.path.join(folder, DATABASES[name]))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def settings(self) -> dict:
+        # DuckDB config of every connection this resource opens
+        config = {"checkpoint_threshold": self.checkpoint_threshold}
+        if self.threads:
+            config["threads"] = self.threads
+        if self.memory_limit:
+            config["memory_limit"] = self.memory_limit
+        return config
+
+    def open(self, path: str, read_only: bool=False):
+        import duckdb as db
+        # Writers in other processes hold an exclusive file lock, back off and retry
+        for attempt in range(self.lock_retries):
+            try:
+                return db.connect(path, read_only=read_only, config=self.settings())
+            except db.IOException:
+                if attempt == self.lock_retries - 1:
+                    raise
+                time.sleep(0.2 * (attempt + 1))
+
+    def get_connection(self, name: str):
+        """
+        A cursor on the run's read-write connection to a database.
+        Cursors are cheap, safe to use from other threads and to close.
+        """
+        if name not in self._connections:
+            self._connections[name] = self.open(self.path(name))
+        return self._connections[name].cursor()
+
+    def get_read_connection(self, name: str):
+        """
+        A read-only connection to a database, for assets that only query it.
+        When this process already writes the database, a cursor on that connection is
+        returned instead: DuckDB shares one instance per file within a process.
+        """
+        import duckdb as db
+        path = self.path(name)
+        if name in self._connections or not os.path.exists(path):
+            return self.get_connection(name)
+        try:
+            return self.open(path, read_only=True)
+        except db.ConnectionException:
+            # Open read-write elsewhere in this process, e.g. an ETL thread
+            return self.get_connection(name)
+
+    def checkpoint(self, name: str) -> None:
+        """
+        Fold the database's WAL into the file
+        """
+        self.get_connection(name).execute("CHECKPOINT;")
+
+    def close(self, name: str) -> None:
+        """
+        Checkpoint and close the run's connection to a database
+        """
+        import duckdb as db
+        conn = self._connections.pop(name, None)
+        if conn is None:
+            return
+        try:
+            conn.execute("CHECKPOINT;")
+        except db.Error:
+            # Another connection still has a transaction open, its close checkpoints
+            pass
+        conn.close()
@@ -0,0 +1,106 @@
+import os
+
+from datetime import datetime, timedelta
+from dagster import (
+    sensor, run_status_sensor, schedule, RunRequest, SkipReason, RunsFilter, DagsterRunStatus,
+    SensorEvaluationContext, RunStatusSensorContext, ScheduleEvaluationContext,
+)
+
+from .assets.etl import goes_prefix, s3_client
+from .assets.etl.manifest import list_objects
+
+# Runs that have not finished yet
+IN_FLIGHT = [DagsterRunStatus.QUEUED, DagsterRunStatus.NOT_STARTED, DagsterRunStatus.STARTING, DagsterRunStatus.STARTED]
+
+def partition_key_for(hour: datetime) -> str:
+    # Hourly partition key of an hour
+    return hour.strftime("%Y-%m-%d-%H:00")
+
+def poll_hours(now: datetime, lookback: int) -> list:
+    """
+    Hours to poll, oldest first: the hour in progress and the lookback hours before it
+    """
+    current = now.replace(minute=0, second=0, microsecond=0)
+    return [current - timedelta(hours=h) for h in range(lookback, -1, -1)]
+
+def new_keys(s3, bucket: str, hour: datetime, cursor: str) -> list:
+    """
+    Keys of an hour's prefix that sort after the cursor, the last key already requested
+    """
+    prefix = goes_prefix(hour)
+    # Keys sort by hour then scan start, a cursor from an earlier hour lists the whole prefix
+    start_after = cursor if cursor and cursor > prefix else None
+    return [obj['Key'] for obj in list_objects(s3, bucket, prefix, start_after) if obj['Key'].endswith(".nc")]
+
+def in_flight(instance, job_name: str, partition_key: str) -> bool:
+    # A run of the job for the partition is queued or running
+    records = instance.get_run_records(
+        filters=RunsFilter(job_name=job_name, statuses=IN_FLIGHT, tags={"dagster/partition": partition_key}),
+        limit=1,
+    )
+    return len(records) > 0
+
+def build_granule_sensor(job, minimum_interval_seconds: int=60):
+    """
+    Sensor polling the GOES prefixes for new granules and requesting a micro-batch run of job
+    per hour partition, restricted to the new keys. The cursor is the last key requested.
+    """
+    @sensor(name="new_granule_sensor", job=job, minimum_interval_seconds=minimum_interval_seconds,
+            description="Polls the GOES prefixes and runs the ETL on new granules only.")
+    def new_granule_sensor(context: SensorEvaluationContext):
+        bucket = os.getenv("S3_BUCKET")
+        lookback = int(os.getenv("SENSOR_LOOKBACK_HOURS", 1))
+        s3 = s3_client()
+        cursor = context.cursor or ""
+        requests = []
+        for hour in poll_hours(datetime.utcnow(), lookback):
+            keys = new_keys(s3, bucket, hour, cursor)
+            if not keys:
+                continue
+            partition_key = partition_key_for(hour)
+            if in_flight(context.instance, job.name, partition_key):
+                # Hours share folders between runs, wait for this one; later hours wait behind it
+                context.log.info(f"Run for {partition_key} in flight, {len(keys)} new keys wait for the next tick")
+                break
+            requests.append(RunRequest(
+                run_key=f"{partition_key}:{keys[-1]}",
+                partition_key=partition_key,
+                run_config={"ops": {"source": {"config": {"keys": keys}}}},
+                tags={"lightning_map/new_keys": str(len(keys))},
+            ))
+            cursor = keys[-1]
+        if not requests:
+            return SkipReason("No new granules")
+        context.update_cursor(cursor)
+        return requests
+
+    return new_granule_sensor
+
+def build_clustering_sensor(monitored_job, request_job, minimum_interval_seconds: int=60):
+    """
+    Run status sensor requesting a clustering run of the hour each successful ETL run loaded
+    """
+    @run_status_sensor(name="micro_clustering_sensor", run_status=DagsterRunStatus.SUCCESS,
+                       monitored_jobs=[monitored_job], request_job=request_job,
+                       minimum_interval_seconds=minimum_interval_seconds,
+                       description="Clusters the hour an ETL micro-batch just loaded.")
+    def micro_clustering_sensor(context: RunStatusSensorContext):
+        partition_key = context.dagster_run.tags.get("dagster/partition")
+        if not partition_key:
+            return SkipReason("ETL run without an hour partition")
+        hour = datetime.strptime(partition_key, "%Y-%m-%d-%H:%M")
+        return RunRequest(run_key=context.dagster_run.run_id, tags={"cluster/window_start": hour.isoformat()})
+
+    return micro_clustering_sensor
+
+def build_catch_up_schedule(job, cron_schedule: str="5 * * * *"):
+    """
+    Hourly run of the hour that just closed, picking up any granule the sensor missed
+    """
+    @schedule(name="hourly_etl_schedule", job=job, cron_schedule=cron_schedule, execution_timezone="UTC")
+    def hourly_etl_schedule(context: ScheduleEvaluationContext):
+        hour = context.scheduled_execution_time.replace(minute=0, second=0, microsecond=0, tzinfo=None) - timedelta(hours=1)
+        partition_key = partition_key_for(hour)
+        return RunRequest(run_key=partition_key, partition_key=partition_key)
+
+    return hourly_etl_schedule
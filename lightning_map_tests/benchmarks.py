@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for the ETL and clustering hot paths on synthetic GLM granules.
+
+    python lightning_map_tests/benchmarks.py --sizes 1000 10000 50000 --out bench/HEAD.json
+    python lightning_map_tests/benchmarks.py --sizes 1000 10000 --compare bench/HEAD.json
+
+Each stage is timed at each flash count and the median of --repeat runs is saved as JSON,
+along with the time to import the code location in a fresh interpreter.
+With --compare, stages slower than the baseline by more than --tolerance are reported and
+the exit code is 1.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+import duckdb as db
+
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from glm_synthetic import write_glm_granule, granule_name
+from lightning_map.assets.etl import etl
+from lightning_map.assets.clustering import clustering
+
+# Clustering window of the synthetic granule
+WINDOW_START = datetime(2023, 2, 17, 21, 0)
+WINDOW_END = datetime(2023, 2, 17, 22, 0)
+
+def timed(fn, repeat: int) -> list:
+    """
+    Wall clock seconds of repeat calls to fn
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+def bench_size(workdir: Path, n_flashes: int, repeat: int, k: int) -> list:
+    """
+    Time every stage at one flash count
+    """
+    extract_folder, transform_folder, load_folder = workdir / "Extract", workdir / "transform", workdir / "Load"
+    for folder in [extract_folder, transform_folder, load_folder]:
+        folder.mkdir(parents=True)
+    filename = granule_name(WINDOW_START)
+    write_glm_granule(extract_folder / filename, n_flashes, start=WINDOW_START)
+    conn = db.connect(str(load_folder / "glmFlash.db"))
+    results = {}
+
+    for output_format in ["csv", "parquet"]:
+        def transform_once():
+            # transform() will not overwrite its csv outputs
+            for f in os.listdir(transform_folder):
+                if f.endswith(".csv"):
+                    os.remove(transform_folder / f)
+            etl.transform(str(extract_folder), str(transform_folder), filename, output_format=output_format)
+        results[f"transform_{output_format}"] = timed(transform_once, repeat)
+
+    def load_once():
+        # A fresh copy of the transformed granule and an empty ledger for each repeat
+        for f in os.listdir(transform_folder):
+            if f.endswith(".parquet"):
+                shutil.copy(transform_folder / f, load_folder)
+        conn.execute("DROP TABLE IF EXISTS flash; DROP TABLE IF EXISTS loaded_files;")
+        etl.load(str(load_folder), conn=conn)
+    results["load"] = timed(load_once, repeat)
+
+    geo_df = clustering.preprocess(conn, WINDOW_START, WINDOW_END)
+    results["preprocess"] = timed(lambda: clustering.preprocess(conn, WINDOW_START, WINDOW_END), repeat)
+    results["kmeans_model"] = timed(lambda: clustering.kmeans_model(geo_df, k), repeat)
+    results["sil_evaluation"] = timed(lambda: clustering.sil_evaluation(geo_df), repeat)
+    results["elb_evaluation"] = timed(lambda: clustering.elb_evaluation(geo_df), repeat)
+    conn.close()
+
+    return [
+        {
+            "stage": stage,
+            "flashes": n_flashes,
+            "repeat": repeat,
+            "seconds_median": float(np.median(seconds)),
+            "seconds_min": float(np.min(seconds)),
+            "flashes_per_sec": float(n_flashes / np.median(seconds)) if np.median(seconds) > 0 else None,
+        }
+        for stage, seconds in results.items()
+    ]
+
+# Dependencies only runs need, importing the code location must not load them
+HEAVY_MODULES = ["netCDF4", "boto3", "botocore", "duckdb", "sklearn", "scipy", "tqdm"]
+
+def import_time(module: str="lightning_map", repeat: int=3) -> dict:
+    """
+    Median seconds to import module in a fresh interpreter, as the code location server
+    does on every reload, and which of the heavy modules the import loaded
+    """
+    code = (
+        "import sys, time, json; start = time.perf_counter(); import " + module + "; "
+        "print(json.dumps({'seconds': time.perf_counter() - start, "
+        f"'heavy_modules': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    return {"module": module, "seconds": float(np.median([r["seconds"] for r in runs])), "heavy_modules": runs[-1]["heavy_modules"]}
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def run(sizes: list, repeat: int=3, k: int=12) -> dict:
+    """
+    Run the suite over sizes, returning the JSON report
+    """
+    rows = []
+    for n_flashes in sizes:
+        workdir = Path(tempfile.mkdtemp(prefix="lightning_bench_"))
+        try:
+            rows.extend(bench_size(workdir, n_flashes, repeat, k))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "commit": git_commit(),
+        "created_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "import": import_time(repeat=repeat),
+        "results": rows,
+    }
+
+def compare(report: dict, baseline: dict, tolerance: float=0.2) -> list:
+    """
+    Stages slower than the baseline by more than tolerance, as (stage, flashes, ratio)
+    """
+    previous = {(r["stage"], r["flashes"]): r["seconds_median"] for r in baseline["results"]}
+    regressions = []
+    for r in report["results"]:
+        before = previous.get((r["stage"], r["flashes"]))
+        if before:
+            ratio = r["seconds_median"] / before
+            if ratio > 1 + tolerance:
+                regressions.append((r["stage"], r["flashes"], round(ratio, 2)))
+    if report.get("import") and baseline.get("import"):
+        ratio = report["import"]["seconds"] / baseline["import"]["seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append(("import", 0, round(ratio, 2)))
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="flash counts per granule")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--k", type=int, default=12, help="clusters for kmeans_model")
+    parser.add_argument("--out", help="write the JSON report here")
+    parser.add_argument("--compare", help="baseline JSON report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a stage is flagged")
+    args = parser.parse_args(argv)
+
+    report = run(args.sizes, args.repeat, args.k)
+    print(f"{'import':>16} {report['import']['module']:>16}  {report['import']['seconds'] * 1000:10.1f} ms  heavy modules: {report['import']['heavy_modules']}")
+    for r in report["results"]:
+        print(f"{r['stage']:>16} {r['flashes']:>8} flashes  {r['seconds_median'] * 1000:10.1f} ms")
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for stage, flashes, ratio in regressions:
+            print(f"REGRESSION {stage} at {flashes} flashes: {ratio}x baseline")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import numpy as np
+import netCDF4 as nc
+
+from datetime import datetime, timedelta
+
+# GLM-L2-LCFA granules cover 20 seconds
+GRANULE_SECONDS = 20
+
+def granule_name(start: datetime, satellite: str="G18") -> str:
+    """
+    GLM-L2-LCFA style file name for a granule starting at start
+    """
+    def stamp(t):
+        # Year, day of year, time and tenths of a second
+        return f"{t.strftime('%Y%j%H%M%S')}{t.microsecond // 100000}"
+
+    end = start + timedelta(seconds=GRANULE_SECONDS)
+    return f"OR_GLM-L2-LCFA_{satellite}_s{stamp(start)}_e{stamp(end)}_c{stamp(end)}.nc"
+
+def write_glm_granule(path, n_flashes: int, seed: int=0, start: datetime=datetime(2023, 2, 17, 21, 0), n_cells: int=8):
+    """
+    Write a synthetic GLM-L2-LCFA granule with the flash variables the pipeline reads.
+    Variables are packed the way GLM packs them: scaled signed shorts flagged _Unsigned with
+    a fill value of -1, so offsets and ids past 32767 wrap unless read as unsigned. Flashes
+    are drawn around n_cells storm centres so clustering has structure to find.
+    """
+    rng = np.random.default_rng(seed)
+    centres = np.column_stack([rng.uniform(20, 50, n_cells), rng.uniform(-120, -70, n_cells)])
+    cell = rng.integers(0, n_cells, n_flashes)
+    lat = centres[cell, 0] + rng.normal(0, 0.2, n_flashes)
+    lon = centres[cell, 1] + rng.normal(0, 0.2, n_flashes)
+    with nc.Dataset(path, mode='w') as glm:
+        glm.createDimension('number_of_flashes', n_flashes)
+        flash_id = glm.createVariable('flash_id', 'i2', ('number_of_flashes',), fill_value=np.int16(-1))
+        flash_id._Unsigned = "true"
+        flash_id[:] = (np.arange(n_flashes) % 65535).astype("u2")
+        flash_time = glm.createVariable('flash_time_offset_of_first_event', 'i2', ('number_of_flashes',), fill_value=np.int16(-1))
+        flash_time._Unsigned = "true"
+        flash_time.units = f"seconds since {start.strftime('%Y-%m-%d %H:%M:%S')}.000"
+        flash_time.scale_factor = np.float32(0.0003814756)
+        flash_time.add_offset = np.float32(-5.0)
+        flash_time[:] = np.sort(rng.uniform(0, GRANULE_SECONDS - 0.01, n_flashes))
+        flash_lat = glm.createVariable('flash_lat', 'f4', ('number_of_flashes',))
+        flash_lat[:] = lat
+        flash_lon = glm.createVariable('flash_lon', 'f4', ('number_of_flashes',))
+        flash_lon[:] = lon
+        flash_energy = glm.createVariable('flash_energy', 'i2', ('number_of_flashes',), fill_value=np.int16(-1))
+        flash_energy._Unsigned = "true"
+        flash_energy.scale_factor = np.float32(1.52597e-17)
+        flash_energy[:] = rng.uniform(1e-15, 1e-12, n_flashes)
+    return path
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+import os
+
+import benchmarks
+
+def test_benchmark_suite_reports_every_stage():
+    """
+    Test the benchmark suite times every hot path and flags slowdowns against a baseline.
+    """
+    report = benchmarks.run(sizes=[300], repeat=1, k=4)
+    stages = {r["stage"] for r in report["results"]}
+    assert stages == {"transform_csv", "transform_parquet", "load", "preprocess", "kmeans_model", "sil_evaluation", "elb_evaluation"}
+    assert all(r["flashes"] == 300 and r["seconds_median"] > 0 for r in report["results"])
+
+    baseline = {"results": [dict(r, seconds_median=r["seconds_median"] / 2) for r in report["results"]]}
+    assert len(benchmarks.compare(report, baseline, tolerance=0.5)) == len(report["results"])
+    assert benchmarks.compare(report, report) == []
+
+def test_code_location_imports_without_heavy_dependencies():
+    """
+    Test importing the code location loads none of the run-time only dependencies and fits the load budget.
+    """
+    report = benchmarks.import_time(repeat=1)
+    assert report["heavy_modules"] == []
+    assert report["seconds"] < float(os.getenv("IMPORT_BUDGET_SECONDS", 5))
@@ -1,5 +1,281 @@
 #!/usr/bin/env python
 
-from eda import ingestion, clustering
+import os
 import logging
 
+import numpy as np
+import pandas as pd
+import duckdb as db
+
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from dagster import asset, materialize
+from glm_synthetic import write_glm_granule, granule_name
+from test_etl import DirectoryS3
+from lightning_map.assets import etl as etl_assets, metrics
+from lightning_map.assets import clustering as clustering_assets
+from lightning_map.assets.clustering import clustering, cache
+from lightning_map.assets.clustering.ingestor import work_units, ingestion
+from lightning_map.assets.etl.etl import create_flash_tables
+from lightning_map.resources import DuckDBResource
+
+def flash_store(n_flashes: int, seed: int=0):
+    """
+    In-memory flash table with one hour of flashes from 2023-02-17 21:00
+    """
+    rng = np.random.default_rng(seed)
+    flashes = pd.DataFrame({
+        "flash_id": np.arange(n_flashes),
+        "ts": pd.Timestamp("2023-02-17 21:00") + pd.to_timedelta(np.sort(rng.uniform(0, 3600, n_flashes)), unit="s"),
+        "lat": rng.uniform(20, 50, n_flashes),
+        "lon": rng.uniform(-120, -70, n_flashes),
+        "energy": rng.uniform(1e-15, 1e-12, n_flashes),
+        "source_file": [f"OR_GLM_s{i // 100}.nc" for i in range(n_flashes)],
+    })
+    conn = db.connect()
+    create_flash_tables(conn)
+    conn.execute("INSERT INTO flash SELECT * FROM flashes;")
+    return conn
+
+def test_preprocess_window_dedup():
+    """
+    Test preprocess returns only the window's flashes, once each, as lon/lat columns.
+    """
+    conn = flash_store(600)
+    # Reloaded duplicate of one granule
+    conn.execute("INSERT INTO flash SELECT * FROM flash WHERE source_file = 'OR_GLM_s0.nc';")
+
+    geo_df = clustering.preprocess(conn, datetime(2023, 2, 17, 21, 0), datetime(2023, 2, 17, 21, 30))
+    in_window = conn.execute("SELECT count(*) FROM flash WHERE ts < '2023-02-17 21:30' AND source_file <> 'OR_GLM_s0.nc';").fetchone()[0]
+    in_window += conn.execute("SELECT count(*) FROM flash WHERE ts < '2023-02-17 21:30' AND source_file = 'OR_GLM_s0.nc';").fetchone()[0] // 2
+
+    assert list(geo_df.columns) == ["ts_date", "lon", "lat"]
+    assert len(geo_df) == in_window
+    assert geo_df["ts_date"].is_monotonic_increasing
+
+def test_cluster_window_resolves_when_the_run_starts(monkeypatch):
+    """
+    Test a run's window comes from its tag, else the hour before the run was created, not the import time.
+    """
+    monkeypatch.setenv("CLUSTER_WINDOW_HOURS", "2")
+
+    @asset
+    def window(context):
+        return clustering_assets.cluster_window(context)
+
+    tagged = materialize([window], tags={"cluster/window_start": "2023-02-17T21:00:00"})
+    assert tagged.output_for_node("window") == (datetime(2023, 2, 17, 21), datetime(2023, 2, 17, 23))
+
+    before = datetime.utcnow()
+    start, end = materialize([window]).output_for_node("window")
+    assert start.minute == 0 and end - start == timedelta(hours=2)
+    assert before - timedelta(hours=2) < start <= before - timedelta(hours=1)
+
+def test_cluster_assets_skip_windows_with_too_few_flashes(tmp_path, monkeypatch):
+    """
+    Test a quiet or early window yields empty clusters and a skipped note instead of failing the fits.
+    """
+    monkeypatch.setenv("NUM_OF_CLUSTERS", "12")
+    monkeypatch.setenv("CLUSTER_CACHE", "0")
+    monkeypatch.setattr(metrics, "metrics_config", lambda: str(tmp_path / "pipelineMetrics.db"))
+    geo_df = clustering.preprocess(flash_store(300), datetime(2023, 2, 17, 21), datetime(2023, 2, 17, 22))
+    duckdb = DuckDBResource(data_folder=str(tmp_path))
+    assets = [clustering_assets.kmeans_cluster, clustering_assets.dbscan_cluster, clustering_assets.k_sweeper, clustering_assets.Silhouette_evaluator]
+
+    for flashes in [geo_df.iloc[:0], geo_df.iloc[:3]]:
+        @asset(name="preprocessor")
+        def window():
+            return flashes
+
+        result = materialize([window] + assets, resources={"duckdb": duckdb})
+        assert result.success
+        clusters = result.output_for_node("kmeans_cluster")
+        assert clusters.empty and list(clusters.columns) == ["lon", "lat", "Cluster"]
+        assert "skipped" in result.asset_materializations_for_node("kmeans_cluster")[0].metadata
+        assert result.output_for_node("k_sweeper").empty
+    # Three flashes are still enough for density clusters
+    assert len(result.output_for_node("dbscan_cluster")) == 3
+
+def test_window_clusters_replace_reruns_and_look_up_by_hour():
+    """
+    Test cluster outputs are keyed by window, reruns replace their window and legacy rows are set aside.
+    """
+    conn = db.connect()
+    conn.execute("CREATE TABLE cluster_analysis AS SELECT 1.0 AS lon, 2.0 AS lat, 0 AS Cluster;")
+    geo_df = clustering.preprocess(flash_store(300), datetime(2023, 2, 17, 21), datetime(2023, 2, 17, 22))
+    hour = datetime(2023, 2, 17, 21)
+
+    for window_start in [hour, hour + timedelta(hours=1), hour]:
+        clusters = clustering.kmeans_model(geo_df, 3)
+        run = clustering.save_window_clusters(conn, clusters, window_start, window_start + timedelta(hours=1), "kmeans", run_id=str(window_start))
+    assert run["k"] == 3 and run["points"] == 300 and run["inertia"] > 0
+    assert conn.execute("SELECT count(*) FROM cluster_analysis_legacy;").fetchone() == (1,)
+    assert conn.execute("SELECT window_start, count(*) FROM cluster_analysis GROUP BY ALL ORDER BY ALL;").fetchall() == [
+        (hour, 300), (hour + timedelta(hours=1), 300)]
+
+    latest, latest_run = clustering.latest_clusters(conn, "kmeans")
+    assert len(latest) == 300 and latest_run["window_start"].iloc[0] == hour + timedelta(hours=1)
+    points, hour_run = clustering.clusters_for_hour(conn, hour + timedelta(minutes=30), "kmeans")
+    assert len(points) == 300 and hour_run["run_id"].iloc[0] == str(hour)
+    assert clustering.clusters_for_hour(conn, hour, "dbscan")[0].empty
+
+    clustering.save_window_scores(conn, clustering.k_sweep(geo_df, range(1, 4), max_workers=1, sample_size=100), hour)
+    assert conn.execute("SELECT count(*) FROM cluster_scores WHERE window_start = ?;", [hour]).fetchone() == (3,)
+    assert clustering.prune_clusters(conn, hour + timedelta(hours=1)) == 300
+    assert conn.execute("SELECT count(*) FROM cluster_runs;").fetchone() == (1,)
+
+def test_cache_memoizes_by_content_and_evicts_least_recent(tmp_path):
+    """
+    Test cached fits are keyed by the points and parameters, and the cache stays under its size bound.
+    """
+    geo_df = clustering.preprocess(flash_store(300), datetime(2023, 2, 17, 21), datetime(2023, 2, 17, 22))
+    key = cache.fingerprint(geo_df, model="k_sweep", k_values=range(1, 4))
+    # Same content, new frame: same key; moved point or other parameters: new key
+    assert cache.fingerprint(geo_df.copy(), model="k_sweep", k_values=range(1, 4)) == key
+    moved = geo_df.copy()
+    moved.loc[0, "lat"] += 1e-9
+    assert cache.fingerprint(moved, model="k_sweep", k_values=range(1, 4)) != key
+    assert cache.fingerprint(geo_df, model="k_sweep", k_values=range(1, 5)) != key
+
+    calls = []
+    def sweep():
+        calls.append(1)
+        return clustering.k_sweep(geo_df, range(1, 4), max_workers=1, sample_size=100)
+
+    first, hit = cache.memoize(str(tmp_path), key, sweep)
+    assert not hit
+    second, hit = cache.memoize(str(tmp_path), key, sweep)
+    assert hit and len(calls) == 1
+    pd.testing.assert_frame_equal(first, second)
+
+    entry_bytes = os.path.getsize(tmp_path / f"{key}.pkl")
+    for i in range(3):
+        cache.cache_put(str(tmp_path), f"entry{i}", first, max_bytes=2 * entry_bytes)
+    assert sorted(os.listdir(tmp_path)) == ["entry1.pkl", "entry2.pkl"]
+
+def test_k_sweep_shares_fits_between_evaluators():
+    """
+    Test one sweep feeds both the silhouette and elbow evaluations.
+    """
+    geo_df = clustering.preprocess(flash_store(400), datetime(2023, 2, 17, 21), datetime(2023, 2, 17, 22))
+
+    sweep = clustering.k_sweep(geo_df, range(1, 6), max_workers=2, sample_size=100)
+    assert list(sweep.columns) == ["k", "inertia", "silhouette", "fit_seconds"]
+    assert list(sweep["k"]) == [1, 2, 3, 4, 5]
+    assert np.isnan(sweep["silhouette"].iloc[0]) and sweep["silhouette"].iloc[1:].between(-1, 1).all()
+
+    sil_df = clustering.sil_evaluation(geo_df, sweep=sweep)
+    assert list(sil_df["k"]) == [2, 3, 4, 5]
+    assert clustering.elb_evaluation(geo_df, sweep=sweep) == list(sweep["inertia"])
+    assert sweep["inertia"].is_monotonic_decreasing
+
+def test_streaming_cluster_warm_starts_from_saved_centroids():
+    """
+    Test streaming mode persists centroids and warm starts the next batch from them.
+    """
+    geo_df = clustering.preprocess(flash_store(800), datetime(2023, 2, 17, 21), datetime(2023, 2, 17, 22))
+    conn = db.connect()
+    assert clustering.load_centroids(conn, 4) is None
+
+    first, centroids = clustering.minibatch_model(geo_df.iloc[:400], 4)
+    clustering.save_centroids(conn, centroids, "streaming")
+    saved = clustering.load_centroids(conn, 4)
+    np.testing.assert_allclose(saved, centroids)
+
+    second, centroids = clustering.minibatch_model(geo_df.iloc[400:], 4, saved)
+    assert list(second.columns) == ["lon", "lat", "Cluster"] and second["Cluster"].nunique() == 4
+    drift = clustering.centroid_drift(geo_df.iloc[400:], centroids, 4)
+    assert drift["drift_mean_deg"] >= 0 and drift["inertia_ratio"] >= 0.9
+
+def test_dbscan_cluster_finds_dense_cells_and_noise():
+    """
+    Test density clustering separates two storm cells from scattered noise.
+    """
+    rng = np.random.default_rng(1)
+    cells = [rng.normal(center, 0.05, size=(200, 2)) for center in [(-95.0, 30.0), (-80.0, 40.0)]]
+    noise = rng.uniform((-120, 20), (-70, 50), size=(20, 2))
+    geo_df = pd.DataFrame(np.vstack(cells + [noise]), columns=["lon", "lat"])
+
+    results = clustering.dbscan_model(geo_df, eps_km=15, min_samples=10)
+
+    assert list(results.columns) == ["lon", "lat", "Cluster"]
+    labels = results["Cluster"].astype(int)
+    assert labels[labels >= 0].nunique() == 2
+    assert labels.iloc[:200].nunique() == 1 and labels.iloc[200:400].nunique() == 1
+    assert (labels.iloc[400:] == -1).mean() > 0.8
+    # Labels match a fit without the grid pre-pass, up to the naming of the clusters
+    exact = clustering.dbscan_model(geo_df, eps_km=15, min_samples=10, cell_fraction=1e-9)["Cluster"].astype(int)
+    assert pd.crosstab(labels, exact).gt(0).sum(axis=1).eq(1).all()
+
+def test_work_units_cover_dates_and_hours():
+    """
+    Test a date/hour range becomes one partition key per hour.
+    """
+    assert work_units("2023-02-17 21:14:00", "2023-02-17 21:14:00", "21") == ["2023-02-17-21:00"]
+    units = work_units("2023-02-17", "2023-02-18", ["0", "23"])
+    assert units == ["2023-02-17-00:00", "2023-02-17-23:00", "2023-02-18-00:00", "2023-02-18-23:00"]
+
+def test_ingestion_backfills_hours_concurrently(tmp_path, monkeypatch):
+    """
+    Test concurrent hourly backfill loads every hour once without changing the environment or cwd.
+    """
+    s3 = DirectoryS3(tmp_path / "bucket")
+    for hour in [21, 22]:
+        for i in range(2):
+            start = datetime(2023, 2, 17, hour, 0, 20 * i)
+            path = write_glm_granule(tmp_path / granule_name(start), 30, seed=hour + i, start=start)
+            s3.put(f"GLM-L2-LCFA/2023/048/{hour}/{path.name}", path.read_bytes())
+            path.unlink()
+    monkeypatch.setenv("S3_BUCKET", "noaa-goes18")
+    monkeypatch.setenv("PRODUCT", "GLM-L2-LCFA")
+    monkeypatch.setenv("TRANSFORM_WORKERS", "1")
+    monkeypatch.setattr(etl_assets, "data_folder", lambda: str(tmp_path / "data"))
+    monkeypatch.setattr(etl_assets, "s3_client", lambda max_workers: s3)
+    monkeypatch.setattr(metrics, "metrics_config", lambda: str(tmp_path / "pipelineMetrics.db"))
+    cwd, environ = os.getcwd(), dict(os.environ)
+
+    ingested = ingestion("2023-02-17", "2023-02-17", ["21", "22"], max_workers=2)
+
+    assert list(ingested["partition_key"]) == ["2023-02-17-21:00", "2023-02-17-22:00"]
+    assert ingested["success"].all(), ingested["error"].tolist()
+    assert os.getcwd() == cwd and dict(os.environ) == environ
+    conn = db.connect(str(tmp_path / "data" / "Load" / "glmFlash.db"))
+    assert conn.execute("SELECT count(*), count(DISTINCT source_file) FROM flash;").fetchone() == (120, 4)
+    assert conn.execute("SELECT sum(flashes) FROM flash_grid;").fetchone() == (120,)
+
+def test_overlapping_runs_of_an_hour_keep_each_others_outputs(tmp_path, monkeypatch):
+    """
+    Test a run of an hour starting while another is between transform and load does not lose its granules.
+    """
+    s3 = DirectoryS3(tmp_path / "bucket")
+    starts = [datetime(2023, 2, 17, 21, 0, 0), datetime(2023, 2, 17, 21, 0, 20)]
+    for i, start in enumerate(starts):
+        path = write_glm_granule(tmp_path / granule_name(start), 30, seed=i, start=start)
+        s3.put(f"GLM-L2-LCFA/2023/048/21/{path.name}", path.read_bytes())
+        path.unlink()
+    monkeypatch.setenv("S3_BUCKET", "noaa-goes18")
+    monkeypatch.setenv("PRODUCT", "GLM-L2-LCFA")
+    monkeypatch.setenv("TRANSFORM_WORKERS", "1")
+    monkeypatch.setattr(etl_assets, "data_folder", lambda: str(tmp_path / "data"))
+    monkeypatch.setattr(etl_assets, "s3_client", lambda max_workers: s3)
+    monkeypatch.setattr(metrics, "metrics_config", lambda: str(tmp_path / "pipelineMetrics.db"))
+    duckdb = DuckDBResource(data_folder=str(tmp_path / "data"))
+    etl = [etl_assets.source, etl_assets.transformations, etl_assets.destination, etl_assets.flash_grid]
+    run_config = lambda key: {"ops": {"source": {"config": {"keys": [f"GLM-L2-LCFA/2023/048/21/{granule_name(key)}"]}}}}
+    transform_files = etl_assets.transform_files
+    overlapping = []
+
+    def transform_then_overlap(*args, **kwargs):
+        results = transform_files(*args, **kwargs)
+        if not overlapping:
+            # The second granule's run starts after this run transformed, before it loads, from another thread as ingestor runs hours
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                overlapping.append(executor.submit(materialize, etl, partition_key="2023-02-17-21:00", resources={"duckdb": duckdb}, run_config=run_config(starts[1])).result())
+        return results
+
+    monkeypatch.setattr(etl_assets, "transform_files", transform_then_overlap)
+    first = materialize(etl, partition_key="2023-02-17-21:00", resources={"duckdb": duckdb}, run_config=run_config(starts[0]))
+
+    assert first.success and overlapping[0].success
+    conn = db.connect(str(tmp_path / "data" / "Load" / "glmFlash.db"))
+    assert conn.execute("SELECT count(*), count(DISTINCT source_file) FROM flash;").fetchone() == (60, 2)
@@ -1,16 +1,336 @@
 #!/usr/bin/env python
 
-from assets import etl
+import os
+import sys
+import time
+import shutil
+import subprocess
+import hashlib
 import logging
 
+import numpy as np
+import pandas as pd
+import netCDF4 as nc
+import duckdb as db
+import pytest
+
+from datetime import datetime, timedelta
+from glm_synthetic import write_glm_granule, granule_name
+from lightning_map.assets.etl import etl, downloader, manifest, grid, retention
+
 # Testing fixtures
 example_bucket_name = 'noaa-goes18'         # Mock s3 bucket
 example_prefix = 'GLM-L2-LCFA/2023/048/21/' # Mock s3 directory
 
-def test_extract_full_sync_count():
+class DirectoryS3:
+    """
+    Directory backed stand-in for the s3 client, keys are paths under root
+    """
+    def __init__(self, root):
+        self.root = root
+        self.downloads = []
+
+    def put(self, key, body: bytes):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+        return {'Key': key, 'Size': len(body), 'ETag': f'"{hashlib.md5(body).hexdigest()}"'}
+
+    def get_paginator(self, operation_name):
+        return DirectoryPaginator(self.root)
+
+    def get_object(self, Bucket, Key):
+        return {'Body': open(os.path.join(self.root, Key), 'rb')}
+
+    def download_file(self, Bucket, Key, Filename):
+        self.downloads.append(Key)
+        shutil.copy(os.path.join(self.root, Key), Filename)
+
+class DirectoryPaginator:
+    """
+    list_objects_v2 paginator over a directory, two keys per page
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def paginate(self, Bucket, Prefix, StartAfter=""):
+        base = os.path.join(self.root, Prefix)
+        names = sorted(os.listdir(base)) if os.path.isdir(base) else []
+        names = [n for n in names if f"{Prefix}{n}" > StartAfter]
+        for i in range(0, max(len(names), 1), 2):
+            page = [{'Key': f"{Prefix}{n}", 'Size': os.path.getsize(os.path.join(base, n))} for n in names[i:i + 2]]
+            yield {'Contents': page} if page else {}
+
+@pytest.mark.skipif(os.getenv("LIVE_S3_TESTS") != "1", reason="Reads the live NOAA bucket, set LIVE_S3_TESTS=1")
+def test_extract_full_sync_count(tmp_path, monkeypatch):
     """
     Test extract full sync count for bucket hour.
     """
     logging.info(f"Testing file extract for: {example_prefix}")
-    
-    assert etl.extract(bucket=example_bucket_name, prefix=example_prefix).shape[0] == 180
\ No newline at end of file
+    s3 = downloader.s3_client()
+    keys = [obj['Key'] for obj in manifest.list_objects(s3, example_bucket_name, example_prefix)]
+    assert len(keys) == 180
+
+    monkeypatch.chdir(tmp_path)
+    path, filename = os.path.split(keys[0])
+    extracted = etl.extract(bucket=example_bucket_name, prefix=example_prefix, filename=filename, filepath=keys[0], s3=s3)
+    assert extracted.shape[0] == 1 and (tmp_path / filename).exists()
+
+def test_download_objects_skips_present_files(tmp_path):
+    """
+    Test concurrent downloads fetch each key once and skip files already extracted.
+    """
+    s3 = DirectoryS3(tmp_path / "bucket")
+    objects = [s3.put(f"{example_prefix}OR_GLM_{i}.nc", os.urandom(64 + i)) for i in range(6)]
+    extract_folder = tmp_path / "Extract"
+    extract_folder.mkdir()
+
+    first = downloader.download_objects(s3, example_bucket_name, objects, str(extract_folder), max_workers=4)
+    assert (first["status"] == "downloaded").all()
+    assert sorted(s3.downloads) == sorted(obj['Key'] for obj in objects)
+
+    second = downloader.download_objects(s3, example_bucket_name, objects, str(extract_folder), max_workers=4)
+    assert (second["status"] == "skipped").all()
+    assert len(s3.downloads) == len(objects)
+
+    stats = downloader.transfer_stats(first, elapsed=1.0)
+    assert stats["downloaded"] == 6 and stats["bytes"] == sum(obj['Size'] for obj in objects)
+
+def test_is_present_matches_etag(tmp_path):
+    """
+    Test a local copy is matched by ETag when the size is unknown.
+    """
+    s3 = DirectoryS3(tmp_path / "bucket")
+    obj = s3.put("key.nc", b"flash")
+    local = tmp_path / "key.nc"
+    local.write_bytes(b"flash")
+    assert downloader.is_present(str(local), etag=obj['ETag'])
+    assert not downloader.is_present(str(local), size=obj['Size'] + 1)
+
+def test_manifest_lists_all_pages_and_tracks_state(tmp_path):
+    """
+    Test the manifest follows pagination, tolerates empty prefixes and only returns new keys.
+    """
+    s3 = DirectoryS3(tmp_path / "bucket")
+    for i in range(5):
+        s3.put(f"{example_prefix}OR_GLM_{i}.nc", b"x" * (i + 1))
+    conn = manifest.manifest_connect(str(tmp_path / "manifest.db"))
+
+    assert manifest.sync_manifest(conn, "empty/", manifest.list_objects(s3, example_bucket_name, "empty/")) == 0
+    assert manifest.sync_manifest(conn, example_prefix, manifest.list_objects(s3, example_bucket_name, example_prefix)) == 5
+    assert len(manifest.pending(conn, example_prefix, "extracted")) == 5
+
+    manifest.mark(conn, ["OR_GLM_0.nc", "OR_GLM_1.nc"], "loaded")
+    s3.put(f"{example_prefix}OR_GLM_5.nc", b"new")
+    manifest.sync_manifest(conn, example_prefix, manifest.list_objects(s3, example_bucket_name, example_prefix))
+    new_keys = [obj['Key'] for obj in manifest.pending(conn, example_prefix, "extracted")]
+    assert new_keys == [f"{example_prefix}OR_GLM_{i}.nc" for i in range(2, 6)]
+    assert manifest.processed(conn, "transformed") == {"OR_GLM_0.nc", "OR_GLM_1.nc"}
+
+def test_transform_parquet_writes_one_typed_file(tmp_path):
+    """
+    Test columnar transform writes one parquet file per granule with typed columns.
+    """
+    write_glm_granule(tmp_path / "OR_GLM_s1.nc", 50)
+    transform_folder = tmp_path / "transform"
+    transform_folder.mkdir()
+
+    etl.transform(str(tmp_path), str(transform_folder), "OR_GLM_s1.nc", output_format="parquet")
+
+    assert os.listdir(transform_folder) == ["OR_GLM_s1.parquet"]
+    flashes = pd.read_parquet(transform_folder / "OR_GLM_s1.parquet")
+    assert list(flashes.columns) == ["flash_id", "ts", "lat", "lon", "energy"]
+    assert flashes["ts"].dtype == "datetime64[ns]" and len(flashes) == 50
+    assert flashes["ts"].min() >= pd.Timestamp("2023-02-17 21:00:00")
+
+def test_transform_files_parallel_isolates_bad_files(tmp_path):
+    """
+    Test parallel transform converts every good granule and records bad ones as errors.
+    """
+    for i in range(5):
+        write_glm_granule(tmp_path / f"OR_GLM_s{i}.nc", 20, seed=i)
+    (tmp_path / "OR_GLM_bad.nc").write_bytes(b"not a netCDF file")
+    transform_folder = tmp_path / "transform"
+    transform_folder.mkdir()
+    filenames = sorted(f for f in os.listdir(tmp_path) if f.endswith(".nc"))
+
+    results = etl.transform_files(str(tmp_path), str(transform_folder), filenames, max_workers=2, chunksize=2, output_format="parquet")
+
+    assert len(results) == 6
+    assert results.set_index("filename").loc["OR_GLM_bad.nc", "status"] == "error"
+    assert (results["status"] == "transformed").sum() == 5
+    assert len(os.listdir(transform_folder)) == 5
+    assert (tmp_path / "OR_GLM_s0.nc.ext").exists()
+
+def test_load_appends_wide_flash_table_once(tmp_path):
+    """
+    Test csv and parquet granules load into one wide flash table and reloads are skipped.
+    """
+    extract_folder, load_folder = tmp_path / "Extract", tmp_path / "Load"
+    extract_folder.mkdir()
+    load_folder.mkdir()
+    write_glm_granule(extract_folder / "OR_GLM_s1.nc", 30, seed=1)
+    write_glm_granule(extract_folder / "OR_GLM_s2.nc", 20, seed=2)
+    etl.transform(str(extract_folder), str(load_folder), "OR_GLM_s1.nc", output_format="parquet")
+    etl.transform(str(extract_folder), str(load_folder), "OR_GLM_s2.nc", output_format="csv")
+    conn = db.connect(str(load_folder / "glmFlash.db"))
+
+    loaded = etl.load(str(load_folder), conn=conn)
+    assert dict(zip(loaded["source_file"], loaded["rows"])) == {"OR_GLM_s1.nc": 30, "OR_GLM_s2.nc": 20}
+    assert not [f for f in os.listdir(load_folder) if f.endswith((".csv", ".parquet"))]
+
+    # Reloading the same granule is a no-op
+    etl.transform(str(extract_folder), str(load_folder), "OR_GLM_s1.nc", output_format="parquet")
+    assert etl.load(str(load_folder), conn=conn).empty
+    flashes = conn.execute("SELECT * FROM flash ORDER BY ts;").df()
+    assert list(flashes.columns) == ["flash_id", "ts", "lat", "lon", "energy", "source_file"]
+    assert len(flashes) == 50 and flashes[["lat", "lon", "energy"]].notna().all().all()
+
+def test_stream_objects_decode_in_memory_and_load(tmp_path):
+    """
+    Test streamed granules are decoded from memory and loaded without touching an extract folder.
+    """
+    s3 = DirectoryS3(tmp_path / "bucket")
+    objects = []
+    for i in range(3):
+        path = write_glm_granule(tmp_path / f"OR_GLM_s{i}.nc", 40, seed=i)
+        objects.append(s3.put(f"{example_prefix}OR_GLM_s{i}.nc", path.read_bytes()))
+        path.unlink()
+    objects.append({'Key': f"{example_prefix}OR_GLM_missing.nc"})
+
+    flashes, records = etl.stream_objects(s3, example_bucket_name, objects, max_workers=2)
+    assert len(flashes) == 120 and flashes["ts"].dtype == "datetime64[ns]"
+    assert records.set_index("filename").loc["OR_GLM_missing.nc", "status"] == "error"
+
+    conn = db.connect(str(tmp_path / "glmFlash.db"))
+    loaded = etl.load_frames(str(tmp_path), flashes, conn=conn)
+    assert sorted(loaded["source_file"]) == ["OR_GLM_s0.nc", "OR_GLM_s1.nc", "OR_GLM_s2.nc"]
+    assert etl.load_frames(str(tmp_path), flashes, conn=conn).empty
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".nc")]
+
+def test_flash_grid_updates_touched_bins_and_matches_raw_counts(tmp_path):
+    """
+    Test the grid cube is rebuilt for the loaded hour only and region queries match the raw flashes.
+    """
+    hour = datetime(2023, 2, 17, 21, 0)
+    conn = db.connect(str(tmp_path / "glmFlash.db"))
+    for i, start in enumerate([hour, hour + timedelta(minutes=7), hour + timedelta(hours=1)]):
+        path = write_glm_granule(tmp_path / granule_name(start), 200, seed=i, start=start)
+        etl.load_frames(str(tmp_path), etl.stream_granule(path.read_bytes(), path.name), conn=conn)
+
+    granules = grid.hour_granules(conn, hour)
+    assert len(granules) == 2
+    updated = grid.update_grid(conn, granules, grid_deg=0.5, bin_minutes=5)
+    assert set(updated["bin_start"]) == {hour, hour + timedelta(minutes=5)}
+    # The next hour is not in the cube until its own update
+    assert grid.query_grid(conn, hour + timedelta(hours=1), hour + timedelta(hours=2), grid_deg=0.5).empty
+
+    cells = grid.query_grid(conn, hour, hour + timedelta(hours=1), 10, 60, -130, -60, grid_deg=0.5)
+    raw = conn.execute("""
+        SELECT count(*), sum(energy), max(energy) FROM flash
+        WHERE ts < ? AND lat BETWEEN 10 AND 60 AND lon BETWEEN -130 AND -60;
+        """, [hour + timedelta(hours=1)]).fetchone()
+    assert cells["flashes"].sum() == raw[0] == 400
+    assert np.isclose(cells["energy_sum"].sum(), raw[1]) and np.isclose(cells["energy_max"].max(), raw[2])
+
+    # Rerunning the update is idempotent
+    grid.update_grid(conn, granules, grid_deg=0.5, bin_minutes=5)
+    assert grid.query_grid(conn, hour, hour + timedelta(hours=1), grid_deg=0.5)["flashes"].sum() == 400
+
+def test_decode_time_matches_num2date_and_masks_fill(tmp_path):
+    """
+    Test packed time offsets decode to datetime64[ns] matching num2date, with fill values as NaT.
+    """
+    path = write_glm_granule(tmp_path / "OR_GLM_s1.nc", 500, seed=3)
+    with nc.Dataset(path, mode='a') as glm:
+        glm.variables['flash_time_offset_of_first_event'][7] = np.ma.masked
+    with nc.Dataset(path, mode='r') as glm:
+        flash_time = glm.variables['flash_time_offset_of_first_event']
+        ts = etl.decode_time(flash_time)
+        expected = nc.num2date(flash_time[:], flash_time.units, only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        # Decoding leaves the variable unpacking as it was
+        assert np.ma.is_masked(flash_time[:][7])
+    assert ts.dtype == "datetime64[ns]" and np.isnat(ts[7]) and np.isnat(ts).sum() == 1
+    valid = ~np.isnat(ts)
+    drift = np.abs(ts[valid] - pd.to_datetime(expected[valid]).values.astype("datetime64[ns]"))
+    assert drift.max() <= np.timedelta64(2, "us")
+    assert etl.time_units("seconds since 2023-02-17 21:00:00.000") == (1_000_000_000, pd.Timestamp("2023-02-17 21:00").value)
+    with pytest.raises(ValueError):
+        etl.time_units("fortnights since 2023-02-17")
+
+def test_decode_time_reads_glm_unsigned_shorts(tmp_path):
+    """
+    Test offsets stored as GLM stores them, signed shorts flagged _Unsigned, decode past 32767 without wrapping.
+    """
+    offsets = [1.0, 10.0, 19.0, 19.99]
+    with nc.Dataset(tmp_path / "OR_GLM_unsigned.nc", mode='w') as glm:
+        glm.createDimension('number_of_flashes', len(offsets) + 1)
+        flash_time = glm.createVariable('flash_time_offset_of_first_event', 'i2', ('number_of_flashes',), fill_value=np.int16(-1))
+        flash_time._Unsigned = "true"
+        flash_time.units = "seconds since 2023-02-17 21:00:00.000"
+        flash_time.scale_factor = np.float32(0.0003814756)
+        flash_time.add_offset = np.float32(-5.0)
+        flash_time[:] = np.ma.masked_array(offsets + [0.0], mask=[False] * len(offsets) + [True])
+        ts = etl.decode_time(flash_time)
+    assert np.isnat(ts[-1])
+    expected = pd.Timestamp("2023-02-17 21:00").to_datetime64() + (np.array(offsets) * 1e9).astype("timedelta64[ns]")
+    assert np.abs(ts[:-1] - expected).max() <= np.timedelta64(1, "ms")
+
+def test_retention_archives_old_hours_compacts_and_collects_garbage(tmp_path):
+    """
+    Test old flashes move to hour partitioned parquet, stay queryable with pruning, and loaded intermediates are removed.
+    """
+    hour = datetime(2023, 2, 17, 21, 0)
+    db_path = str(tmp_path / "glmFlash.db")
+    conn = db.connect(db_path)
+    for i, start in enumerate([hour, hour + timedelta(hours=1), hour + timedelta(days=1)]):
+        path = write_glm_granule(tmp_path / granule_name(start), 100, seed=i, start=start)
+        etl.load_frames(str(tmp_path), etl.stream_granule(path.read_bytes(), path.name), conn=conn)
+
+    archive_folder = str(tmp_path / "Archive" / "flash")
+    archived = retention.archive_flashes(conn, archive_folder, hour + timedelta(hours=2))
+    assert list(archived["rows"]) == [100, 100]
+    assert conn.execute("SELECT count(*) FROM flash;").fetchone() == (100,)
+    assert sorted(os.listdir(os.path.join(archive_folder, "year=2023", "doy=48"))) == ["hour=21", "hour=22"]
+    # Nothing left to archive on a rerun
+    assert retention.archive_flashes(conn, archive_folder, hour + timedelta(hours=2)).empty
+
+    flashes = retention.archived_flashes(conn, archive_folder, hour + timedelta(hours=1), hour + timedelta(hours=2))
+    assert len(flashes) == 100 and flashes["source_file"].unique().tolist() == [granule_name(hour + timedelta(hours=1))]
+    plan = conn.execute(f"""
+        EXPLAIN ANALYZE SELECT count(*) FROM read_parquet('{archive_folder}/**/*.parquet', hive_partitioning = true)
+        WHERE (year * 1000 + doy) * 100 + hour BETWEEN 202304822 AND 202304822;
+        """).fetchall()[0][1]
+    assert "Total Files Read: 1" in plan
+
+    conn.close()
+    stats = retention.compact_database(db_path)
+    assert stats["bytes_after"] <= stats["bytes_before"]
+    assert db.connect(db_path).execute("SELECT count(*) FROM flash;").fetchone() == (100,)
+
+    # A writer in another process holds the file: compaction refuses instead of swapping under it
+    ready = tmp_path / "writer.ready"
+    writer = subprocess.Popen([sys.executable, "-c", (
+        f"import duckdb, pathlib, time; conn = duckdb.connect({db_path!r}); "
+        f"conn.execute('INSERT INTO flash SELECT * FROM flash LIMIT 1;'); pathlib.Path({str(ready)!r}).touch(); time.sleep(30)")])
+    try:
+        while not ready.exists():
+            time.sleep(0.05)
+        with pytest.raises(db.IOException):
+            retention.compact_database(db_path)
+        assert not os.path.exists(f"{db_path}.compact")
+    finally:
+        writer.kill()
+        writer.wait()
+    assert db.connect(db_path).execute("SELECT count(*) FROM flash;").fetchone() == (101,)
+
+    extract_folder = tmp_path / "Extract" / "2023" / "048" / "21"
+    extract_folder.mkdir(parents=True)
+    (extract_folder / f"{granule_name(hour)}.ext").write_bytes(b"granule")
+    (extract_folder / "OR_GLM_pending.nc.ext").write_bytes(b"granule")
+    (tmp_path / "transform").mkdir()
+    (tmp_path / "transform" / f"{granule_name(hour).split('.')[0]}.parquet.trm").write_bytes(b"flashes")
+    removed = retention.collect_garbage([str(tmp_path / "Extract"), str(tmp_path / "transform")], {granule_name(hour)})
+    assert len(removed) == 2 and removed["bytes"].sum() == 14
+    assert os.listdir(extract_folder) == ["OR_GLM_pending.nc.ext"]
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import pytest
+import duckdb as db
+
+from dagster import asset, materialize
+from lightning_map.assets.metrics import stage_metrics, latency_histogram
+
+def test_stage_metrics_attach_metadata_and_record_rows(tmp_path):
+    """
+    Test a stage's metrics reach the asset metadata and the pipeline_metrics table, failures included.
+    """
+    metrics_path = str(tmp_path / "pipelineMetrics.db")
+
+    @asset
+    def timed(context):
+        with stage_metrics(context, "timed", metrics_path) as stage:
+            stage.update({"rows_in": 10, "rows_out": 4, "files": 2, "latencies": [0.02, 0.3], "note": "ok"})
+        return 4
+
+    result = materialize([timed])
+    metadata = result.asset_materializations_for_node("timed")[0].metadata
+    assert metadata["rows_out"].value == 4 and metadata["note"].value == "ok"
+    assert metadata["latency_histogram"].value["<=0.05s"] == 1
+    assert metadata["peak_rss_mb"].value > 0
+
+    class Log:
+        def warning(self, msg):
+            pass
+
+    class Run:
+        run_id = "failed-run"
+
+    class Context:
+        run = Run()
+        log = Log()
+
+    with pytest.raises(ValueError):
+        with stage_metrics(Context(), "broken", metrics_path):
+            raise ValueError("bad granule")
+
+    rows = db.connect(metrics_path).execute("SELECT stage, status, rows_in, files, run_id FROM pipeline_metrics ORDER BY started_at;").fetchall()
+    assert rows == [("timed", "success", 10, 2, result.run_id), ("broken", "failed", None, None, "failed-run")]
+
+def test_latency_histogram_buckets():
+    """
+    Test latencies are bucketed and summarized.
+    """
+    histogram = latency_histogram([0.001, 0.2, 0.2, 120.0])
+    assert histogram["latency_max_s"] == 120.0
+    assert sum(histogram["latency_histogram"].values()) == 4
+    assert histogram["latency_histogram"][">60.0s"] == 1
+    assert latency_histogram([]) == {}
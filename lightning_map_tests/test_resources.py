@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import os
+
+import pytest
+import duckdb as db
+
+from dagster import asset, materialize
+from lightning_map.resources import DuckDBResource
+
+def test_duckdb_resource_reuses_run_connection_and_checkpoints(tmp_path):
+    """
+    Test assets of one run share the database connection and the WAL is folded in when the run ends.
+    """
+    duckdb = DuckDBResource(data_folder=str(tmp_path), threads=2, memory_limit="256MB")
+
+    @asset
+    def writer(duckdb: DuckDBResource):
+        conn = duckdb.get_connection("flash")
+        conn.execute("CREATE TABLE flash AS SELECT range AS flash_id FROM range(1000);")
+        conn.close()
+        # A second connection of the run sees the same database and settings
+        conn = duckdb.get_connection("flash")
+        assert conn.execute("SELECT current_setting('threads');").fetchone() == (2,)
+        return conn.execute("SELECT count(*) FROM flash;").fetchone()[0]
+
+    @asset
+    def reader(writer, duckdb: DuckDBResource):
+        # The run already writes the database, readers get a cursor on its connection
+        conn = duckdb.get_read_connection("flash")
+        return conn.execute("SELECT count(*) FROM flash;").fetchone()[0]
+
+    result = materialize([writer, reader], resources={"duckdb": duckdb})
+    assert result.output_for_node("reader") == 1000
+    path = tmp_path / "Load" / "glmFlash.db"
+    assert path.exists() and not os.path.exists(f"{path}.wal")
+
+def test_duckdb_resource_read_connection_is_read_only(tmp_path):
+    """
+    Test readers outside a writing run get read-only connections on absolute paths.
+    """
+    duckdb = DuckDBResource(data_folder=str(tmp_path))
+    assert os.path.isabs(duckdb.path("clusters"))
+    db.connect(duckdb.path("clusters")).execute("CREATE TABLE cluster_analysis (Cluster INTEGER);").close()
+
+    conn = duckdb.get_read_connection("clusters")
+    assert conn.execute("SELECT count(*) FROM cluster_analysis;").fetchone() == (0,)
+    with pytest.raises(db.InvalidInputException):
+        conn.execute("INSERT INTO cluster_analysis VALUES (1);")
+    conn.close()
+    with pytest.raises(ValueError):
+        duckdb.path("unknown")
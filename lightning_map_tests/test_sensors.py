@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+from datetime import datetime, timezone
+
+from dagster import DagsterInstance, SkipReason, build_sensor_context, build_schedule_context
+from glm_synthetic import granule_name
+from test_etl import DirectoryS3
+from lightning_map import sensors, etl_asset_job, new_granule_sensor, hourly_etl_schedule
+
+NOW = datetime(2023, 2, 17, 22, 10)
+
+class FrozenClock(datetime):
+    @classmethod
+    def utcnow(cls):
+        return NOW
+
+def put_granule(s3, start: datetime):
+    return s3.put(f"GLM-L2-LCFA/{start.strftime('%Y/%j/%H')}/{granule_name(start)}", b"granule")['Key']
+
+def test_granule_sensor_requests_new_keys_per_hour_and_advances_cursor(tmp_path, monkeypatch):
+    """
+    Test the sensor requests one run per hour with only the keys after its cursor.
+    """
+    s3 = DirectoryS3(tmp_path / "bucket")
+    monkeypatch.setenv("S3_BUCKET", "noaa-goes18")
+    monkeypatch.setenv("PRODUCT", "GLM-L2-LCFA")
+    monkeypatch.setattr(sensors, "s3_client", lambda: s3)
+    monkeypatch.setattr(sensors, "datetime", FrozenClock)
+    previous = [put_granule(s3, datetime(2023, 2, 17, 21, 59, s)) for s in (0, 20, 40)]
+    current = [put_granule(s3, datetime(2023, 2, 17, 22, 0, s)) for s in (0, 20)]
+
+    with DagsterInstance.ephemeral() as instance:
+        context = build_sensor_context(instance=instance)
+        requests = new_granule_sensor(context)
+        assert [r.partition_key for r in requests] == ["2023-02-17-21:00", "2023-02-17-22:00"]
+        assert requests[0].run_config["ops"]["source"]["config"]["keys"] == previous
+        assert requests[1].run_config["ops"]["source"]["config"]["keys"] == current
+        assert context.cursor == current[-1]
+
+        # Nothing new since the cursor
+        assert isinstance(new_granule_sensor(build_sensor_context(instance=instance, cursor=context.cursor)), SkipReason)
+
+        # Only the granule that landed since is requested
+        latest = put_granule(s3, datetime(2023, 2, 17, 22, 0, 40))
+        requests = new_granule_sensor(build_sensor_context(instance=instance, cursor=context.cursor))
+        assert [(r.partition_key, r.run_config["ops"]["source"]["config"]["keys"]) for r in requests] == [("2023-02-17-22:00", [latest])]
+
+def test_catch_up_schedule_runs_the_closed_hour():
+    """
+    Test the hourly schedule targets the hour that just closed.
+    """
+    context = build_schedule_context(scheduled_execution_time=datetime(2023, 2, 17, 22, 5, tzinfo=timezone.utc))
+    request = hourly_etl_schedule(context)
+    assert request.partition_key == "2023-02-17-21:00"
+    assert etl_asset_job.name == "etl_job"
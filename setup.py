@@ -9,6 +9,7 @@ setup(
         "duckdb",
         "netCDF4",
         "pandas",
+        "pyarrow",
         "boto3",
         "botocore",
         "scikit-learn",